@@ -0,0 +1,45 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDispatcher:
+    """asyncio execution engine ([Dispatcher] engine = async).
+    A batch runs on one long-lived event loop; every destination ('To') is limited by a semaphore sized by
+    '<destination> concurrency' (default 'default async concurrency'), so hundreds of external calls can be
+    in flight at once. As with DispatchLanes, requests sharing a TriggerObject run one after another.
+    Handler functions without a coroutine version run in the loop's thread pool ('async threads')"""
+
+    def __init__(self, config, execute, routing_key):
+        self.config = config
+        self.execute = execute
+        self.routing_key = routing_key
+        self.default_concurrency = int(config.get('default async concurrency', 50))
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=int(config.get('async threads', 32)),
+                                                          thread_name_prefix='kh-async'))
+        self.semaphores = {}
+
+    def semaphore(self, destination):
+        if destination not in self.semaphores:
+            concurrency = int(self.config.get(f'{str(destination).lower()} concurrency', self.default_concurrency))
+            self.semaphores[destination] = asyncio.Semaphore(max(concurrency, 1))
+        return self.semaphores[destination]
+
+    async def run_chain(self, chain, deferred):
+        for destination, it_request in chain:
+            async with self.semaphore(destination):
+                await self.execute(it_request, deferred)
+
+    async def run_chains(self, kh_requests, deferred):
+        chains = {}
+        for it_request in kh_requests:
+            destination, key = self.routing_key(it_request)
+            chains.setdefault(key, []).append((destination, it_request))
+        await asyncio.gather(*(self.run_chain(chain, deferred) for chain in chains.values()))
+
+    def run_batch(self, kh_requests, deferred=None):
+        self.loop.run_until_complete(self.run_chains(kh_requests, deferred))
+
+    def shutdown(self):
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
@@ -0,0 +1,282 @@
+"""Local stand-ins for the destinations kharon talks to, built on http.server only.
+
+Every server answers after a configurable latency and fails a configurable share of the calls with a 5xx
+or a 429 (with Retry-After), so the dispatcher's retry and rate limiting paths are exercised as well.
+Run on its own to point a manually started dispatcher at it:
+
+    python -m benchmarks.mock_servers --latency-ms 50 --error-rate 0.01 --throttle-rate 0.01
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# The instance simple_salesforce is told to talk to after the (emulated) SOAP login
+SALESFORCE_INSTANCE = 'kharon-bench.my.salesforce.com'
+
+salesforce_login_response = '''<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns="urn:partner.soap.sforce.com">
+<soapenv:Body><loginResponse><result>
+<serverUrl>https://{instance}/services/Soap/u/59.0/00D000000000001</serverUrl>
+<sessionId>00D000000000001!BENCHMARK</sessionId>
+</result></loginResponse></soapenv:Body></soapenv:Envelope>'''
+
+
+class Behaviour:
+    """Latency and failure injection shared by every request of a server"""
+
+    def __init__(self, latency_ms=20, jitter_ms=0, error_rate=0.0, throttle_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'errors': 0, 'throttled': 0}
+
+    def decide(self):
+        """Sleeps for the latency, then returns None (answer normally), 429 or 503"""
+        with self.lock:
+            draw = self.random.random()
+            delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+            self.counters['requests'] += 1
+            if draw < self.throttle_rate:
+                self.counters['throttled'] += 1
+                outcome = 429
+            elif draw < self.throttle_rate + self.error_rate:
+                self.counters['errors'] += 1
+                outcome = 503
+            else:
+                outcome = None
+        time.sleep(delay)
+        return outcome
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, every keep-alive request would wait
+    # for a delayed ACK (about 40 ms) and drown the configured latency
+    disable_nagle_algorithm = True
+    behaviour = None
+    routes = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def reply(self, status, payload=None, content_type='application/json', headers=None):
+        body = b''
+        if payload is not None:
+            body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self):
+        body = self.read_body()
+        injected = self.behaviour.decide()
+        if injected == 429:
+            return self.reply(429, {'error': 'rate limited'}, headers={'Retry-After': str(self.behaviour.retry_after)})
+        if injected is not None:
+            return self.reply(injected, {'error': 'injected failure'})
+        path = urlsplit(self.path).path
+        for method, pattern, route in self.routes:
+            match = re.fullmatch(pattern, path)
+            if method == self.command and match:
+                return route(self, body, *match.groups())
+        return self.reply(404, {'error': f'no route for {self.command} {path}'})
+
+    do_GET = do_POST = do_PATCH = do_DELETE = dispatch
+
+
+class YouTrackHandler(MockHandler):
+    comment_ids = itertools.count(1)
+
+    def issue(self, body, issue_id):
+        if issue_id.endswith('-0'):
+            return self.reply(404, {'error': 'Not found'})
+        number = int(issue_id.rsplit('-', 1)[-1]) if issue_id.rsplit('-', 1)[-1].isdigit() else 0
+        self.reply(200, {
+            'id': f'2-{number}',
+            'summary': f'Benchmark issue {issue_id}',
+            'customFields': [
+                {'projectCustomField': {'field': {'name': 'State'}}, 'value': {'name': 'Open'}},
+                {'projectCustomField': {'field': {'name': 'Priority'}}, 'value': {'name': 'Normal'}},
+                {'projectCustomField': {'field': {'name': 'Fix versions'}}, 'value': None}
+            ],
+            'tags': [{'id': '6-1', 'name': 'Customer impact'}] if number % 3 == 0 else []
+        }, headers={'ETag': f'"{issue_id}-1"'})
+
+    def create_comment(self, body, issue_id):
+        self.reply(200, {'id': f'4-{next(self.comment_ids)}', '$type': 'IssueComment'})
+
+    def update_comment(self, body, issue_id, comment_id):
+        self.reply(200, {'id': comment_id, 'deleted': True})
+
+    routes = [
+        ('GET', r'/api/issues/([^/]+)', issue),
+        ('POST', r'/api/issues/([^/]+)/comments', create_comment),
+        ('POST', r'/api/issues/([^/]+)/comments/([^/]+)', update_comment)
+    ]
+
+
+class SalesforceHandler(MockHandler):
+    record_ids = itertools.count(1)
+
+    def login(self, body, version):
+        self.reply(200, salesforce_login_response.format(instance=SALESFORCE_INSTANCE), content_type='text/xml')
+
+    def upsert_collection(self, body, version):
+        records = json.loads(body or b'{}').get('records', [])
+        self.reply(200, [{'id': f'a0B{next(self.record_ids):015d}', 'success': True, 'errors': [], 'created': False}
+                         for _ in records])
+
+    def get_by_external_id(self, body, version, external_id):
+        self.reply(200, {'Id': f'a0B{next(self.record_ids):015d}', 'YTReadableId__c': external_id})
+
+    def update_record(self, body, version, record_id):
+        self.reply(204)
+
+    def create_record(self, body, version):
+        self.reply(201, {'id': f'a0B{next(self.record_ids):015d}', 'success': True, 'errors': []})
+
+    routes = [
+        ('POST', r'/services/Soap/u/([^/]+)', login),
+        ('PATCH', r'/services/data/v([^/]+)/composite/sobjects/YoutrackIssue__c/YTReadableId__c', upsert_collection),
+        ('GET', r'/services/data/v([^/]+)/sobjects/YoutrackIssue__c/YTReadableId__c/([^/]+)', get_by_external_id),
+        ('PATCH', r'/services/data/v([^/]+)/sobjects/YoutrackIssue__c/([^/]+)', update_record),
+        ('POST', r'/services/data/v([^/]+)/sobjects/YoutrackIssue__c/?', create_record)
+    ]
+
+
+class SlackHandler(MockHandler):
+    users = [{'id': f'U{number:08d}', 'name': f'user{number}', 'profile': {'email': f'user{number}@example.com'}}
+             for number in range(500)]
+    page_size = 200
+
+    def arguments(self, body):
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body or b'{}')
+        query = parse_qs(urlsplit(self.path).query)
+        query.update(parse_qs(body.decode()))
+        return {key: values[0] for key, values in query.items()}
+
+    def post_message(self, body):
+        arguments = self.arguments(body)
+        self.reply(200, {'ok': True, 'channel': arguments.get('channel'), 'ts': f'{time.time():.6f}',
+                         'message': {'text': arguments.get('text')}})
+
+    def users_list(self, body):
+        arguments = self.arguments(body)
+        start = int(arguments.get('cursor') or 0)
+        limit = min(int(arguments.get('limit') or self.page_size), self.page_size)
+        next_cursor = str(start + limit) if start + limit < len(self.users) else ''
+        self.reply(200, {'ok': True, 'members': self.users[start:start + limit],
+                         'response_metadata': {'next_cursor': next_cursor}})
+
+    def lookup_by_email(self, body):
+        email = self.arguments(body).get('email')
+        for user in self.users:
+            if user['profile']['email'] == email:
+                return self.reply(200, {'ok': True, 'user': user})
+        self.reply(200, {'ok': False, 'error': 'users_not_found'})
+
+    routes = [
+        ('POST', r'/api/chat\.postMessage', post_message),
+        ('GET', r'/api/users\.list', users_list),
+        ('POST', r'/api/users\.list', users_list),
+        ('GET', r'/api/users\.lookupByEmail', lookup_by_email),
+        ('POST', r'/api/users\.lookupByEmail', lookup_by_email)
+    ]
+
+
+class ProductBoardHandler(MockHandler):
+    note_ids = itertools.count(1)
+
+    def create_note(self, body):
+        self.reply(201, {'data': {'id': f'note-{next(self.note_ids)}'}})
+
+    routes = [
+        ('POST', r'/notes', create_note)
+    ]
+
+
+handler_classes = {
+    'YouTrack': YouTrackHandler,
+    'Salesforce': SalesforceHandler,
+    'Slack': SlackHandler,
+    'ProductBoard': ProductBoardHandler
+}
+
+
+class MockServer:
+    """One destination served on 127.0.0.1 from a background thread"""
+
+    def __init__(self, destination, behaviour, port=0):
+        handler_class = type(f'{destination}Mock', (handler_classes[destination],), {'behaviour': behaviour})
+        self.destination = destination
+        self.behaviour = behaviour
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=f'mock-{destination}', daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_servers(behaviour_settings=None, ports=None):
+    """Starts a server for every destination, returns {destination: MockServer}.
+    behaviour_settings maps a destination to Behaviour keyword arguments"""
+    behaviour_settings = behaviour_settings or {}
+    ports = ports or {}
+    return {destination: MockServer(destination, Behaviour(**behaviour_settings.get(destination, {})),
+                                    ports.get(destination, 0)).start()
+            for destination in handler_classes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves mock YouTrack, Salesforce, Slack and ProductBoard APIs')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--base-port', type=int, default=18080, help='YouTrack, Salesforce, Slack, ProductBoard '
+                                                                     'listen on consecutive ports from here')
+    args = parser.parse_args()
+    settings = {'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms, 'error_rate': args.error_rate,
+                'throttle_rate': args.throttle_rate}
+    ports = {destination: args.base_port + offset for offset, destination in enumerate(handler_classes)}
+    servers = start_servers({destination: settings for destination in handler_classes}, ports)
+    for destination, server in servers.items():
+        print(f'{destination}: {server.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for server in servers.values():
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""End-to-end benchmark of ingestion and dispatch against the local stand-in servers of benchmarks.mock_servers.
+
+Creates a scratch directory with its own kh.ini and kharon.db, measures /api and /api/bulk ingestion,
+seeds the queue, runs main.processing_loop until the queue is drained and writes a JSON report that can be
+compared with the report of another commit:
+
+    python -m benchmarks.run --rows 100000 --engine threads --latency-ms 20
+    python -m benchmarks.run --rows 100000 --engine async --compare benchmarks/results/<earlier report>.json
+"""
+import argparse
+import configparser
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import http_session
+import main as dispatcher
+import request_logger
+from benchmarks import mock_servers
+from benchmarks import seed as seeder
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def write_config(path, work_dir, servers, args):
+    config = configparser.ConfigParser()
+    config['Database information'] = {'database_path': os.path.join(work_dir, 'kharon.db')}
+    config['Dispatcher'] = {'engine': args.engine, 'default concurrency': str(args.concurrency),
+                            'default async concurrency': str(args.concurrency * 4),
+                            'batching': 'yes' if args.batching else 'no', 'max idle': '0.2',
+                            'retry base seconds': '0.5', 'retry max seconds': '5'}
+    config['Ingestion'] = {'group commit': 'yes' if args.group_commit else 'no'}
+    config['Logging'] = {'log file': os.path.join(work_dir, 'kharon.log'), 'level': 'WARNING'}
+    config['YouTrack'] = {'authorization': 'Bearer benchmark', 'api endpoint': f"{servers['YouTrack'].url}/api",
+                          'required details': 'State, Priority, Customer impact'}
+    config['Salesforce'] = {'username': 'benchmark@example.com', 'password': 'benchmark',
+                            'security_token': 'benchmark'}
+    config['Slack'] = {'token': 'xoxb-benchmark', 'api url': f"{servers['Slack'].url}/api/",
+                       'user cache path': os.path.join(work_dir, 'slack_users.db'),
+                       'message rate': '1000', 'message burst': '100'}
+    config['ProductBoard'] = {'jwt': 'benchmark', 'api_endpoint': f"{servers['ProductBoard'].url}/notes"}
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+    return config
+
+
+def route_salesforce(config, server):
+    """simple_salesforce only speaks https to *.salesforce.com, so the shared Salesforce session
+    sends the login and the instance calls to the plain http stand-in instead"""
+    class RedirectAdapter(HTTPAdapter):
+        def __init__(self, prefix, target, **kwargs):
+            super().__init__(**kwargs)
+            self.prefix = prefix
+            self.target = target
+
+        def send(self, request, **kwargs):
+            request.url = self.target + request.url[len(self.prefix):]
+            return super().send(request, **kwargs)
+
+    session = http_session.get_session('Salesforce', {key: config['Salesforce'][key] for key in config['Salesforce']})
+    retries = session.get_adapter('https://').max_retries
+    for prefix in ('https://login.salesforce.com', f'https://{mock_servers.SALESFORCE_INSTANCE}'):
+        session.mount(prefix, RedirectAdapter(prefix, server.url, max_retries=retries))
+
+
+def bench_ingestion(requests_count, bulk_size, threads):
+    """Posts requests_count requests one by one to /api and as many again in bulks of bulk_size to
+    /api/bulk, through the Flask test client (no network), from the given number of threads"""
+    factory = seeder.RequestFactory(seed=1)
+    single = list(factory.requests(requests_count))
+    bulks = [single[start:start + bulk_size] for start in range(0, requests_count, bulk_size)]
+    results = {}
+    for name, path, payloads, rows in (('api', '/api', single, 1), ('bulk', '/api/bulk', bulks, None)):
+        clients = threading.local()
+
+        def post(payload):
+            if not hasattr(clients, 'client'):
+                clients.client = request_logger.app.test_client()
+            return clients.client.post(path, json=payload).status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            statuses = list(executor.map(post, payloads))
+        seconds = time.perf_counter() - started
+        accepted = sum(rows or len(payload) for payload, status in zip(payloads, statuses) if status == 200)
+        results[name] = {'calls': len(payloads), 'rows': accepted, 'seconds': round(seconds, 3),
+                         'rows_per_second': round(accepted / seconds, 1) if seconds else None,
+                         'failed_calls': sum(status != 200 for status in statuses)}
+    return results
+
+
+def bench_dispatch(database_path, timeout):
+    """Runs the dispatcher until no request is pending (or timeout), returns its throughput and the
+    queue latency (createdDatetime to completion) of the completed requests"""
+    finished_at = {}
+    for name in ('complete', 'dead_letter'):
+        original = getattr(dispatcher.request_status, name)
+
+        def recorder(request_uuid, *args, original=original, **kwargs):
+            finished_at[request_uuid] = time.time()
+            return original(request_uuid, *args, **kwargs)
+        setattr(dispatcher.request_status, name, recorder)
+
+    con = sqlite3.connect(database_path)
+    stop = threading.Event()
+    loop = threading.Thread(target=dispatcher.processing_loop, args=(stop,), name='kh-benchmark-dispatcher')
+    started = time.perf_counter()
+    loop.start()
+    pending = None
+    while time.perf_counter() - started < timeout:
+        time.sleep(0.5)
+        pending = con.execute('SELECT COUNT(*) FROM kharon_requests WHERE Completed = 0').fetchone()[0]
+        if pending == 0:
+            break
+    seconds = time.perf_counter() - started
+    stop.set()
+    loop.join()
+
+    created = dict(con.execute('SELECT requestUUID, createdDatetime FROM kharon_requests'))
+    outcomes = dict(con.execute('SELECT Completed, COUNT(*) FROM kharon_requests GROUP BY Completed'))
+    latencies = []
+    for request_uuid, finished in finished_at.items():
+        if created.get(request_uuid):
+            latencies.append(finished - datetime.datetime.fromisoformat(created[request_uuid]).timestamp())
+    latencies.sort()
+    con.close()
+    processed = outcomes.get(1, 0) + outcomes.get(2, 0)
+    return {
+        'seconds': round(seconds, 3),
+        'completed': outcomes.get(1, 0),
+        'dead_lettered': outcomes.get(2, 0),
+        'pending': outcomes.get(0, 0),
+        'requests_per_second': round(processed / seconds, 1) if seconds else None,
+        'queue_latency_seconds': {'p50': percentile(latencies, 0.50), 'p90': percentile(latencies, 0.90),
+                                  'p99': percentile(latencies, 0.99), 'max': latencies[-1] if latencies else None},
+        'handler_registry': dispatcher.request_handlers.stats()
+    }
+
+
+def database_size(database_path):
+    return sum(os.path.getsize(database_path + suffix) for suffix in ('', '-wal', '-shm')
+               if os.path.exists(database_path + suffix))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repository, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Prints the relative change of the headline numbers against an earlier report"""
+    headline = [('ingestion /api rows/s', ('ingestion', 'api', 'rows_per_second')),
+                ('ingestion /api/bulk rows/s', ('ingestion', 'bulk', 'rows_per_second')),
+                ('dispatch requests/s', ('dispatch', 'requests_per_second')),
+                ('queue latency p50 s', ('dispatch', 'queue_latency_seconds', 'p50')),
+                ('queue latency p99 s', ('dispatch', 'queue_latency_seconds', 'p99')),
+                ('database bytes', ('database', 'size_bytes'))]
+    print(f"Compared with {baseline.get('commit', '?')[:10]}:")
+    for label, keys in headline:
+        current, previous = report, baseline
+        for key in keys:
+            current = (current or {}).get(key)
+            previous = (previous or {}).get(key)
+        change = f'{(current - previous) / previous:+.1%}' if current is not None and previous else 'n/a'
+        print(f'  {label:<28} {previous!s:>14} -> {current!s:>14}  {change}')
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Benchmarks kharon ingestion and dispatch against mock servers')
+    parser.add_argument('--rows', type=int, default=10000, help='requests seeded into the queue')
+    parser.add_argument('--ingest-requests', type=int, default=2000, help='requests posted to /api and /api/bulk')
+    parser.add_argument('--bulk-size', type=int, default=100)
+    parser.add_argument('--ingest-threads', type=int, default=4)
+    parser.add_argument('--group-commit', action='store_true')
+    parser.add_argument('--engine', choices=['sync', 'threads', 'async'], default='threads')
+    parser.add_argument('--concurrency', type=int, default=8, help='per destination')
+    parser.add_argument('--batching', action='store_true')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for the queue to drain')
+    parser.add_argument('--work-dir', help='scratch directory (a temporary one by default)')
+    parser.add_argument('--output', default=os.path.join(repository, 'benchmarks', 'results'))
+    parser.add_argument('--compare', help='earlier JSON report to compare with')
+    args = parser.parse_args()
+    args.output = os.path.abspath(args.output)
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='kharon-bench-'))
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    behaviour = {'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms, 'error_rate': args.error_rate,
+                 'throttle_rate': args.throttle_rate, 'seed': 0}
+    servers = mock_servers.start_servers({destination: behaviour for destination in mock_servers.handler_classes})
+    config = write_config(os.path.join(work_dir, 'kh.ini'), work_dir, servers, args)
+    route_salesforce(config, servers['Salesforce'])
+    database_path = config['Database information']['database_path']
+
+    report = {'commit': git_commit(), 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': sys.version.split()[0], 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+              'parameters': {key: value for key, value in vars(args).items() if key not in {'output', 'compare'}}}
+    report['ingestion'] = bench_ingestion(args.ingest_requests, args.bulk_size, args.ingest_threads)
+    seed_seconds = seeder.seed(database_path, args.rows)
+    report['seed'] = {'rows': args.rows, 'seconds': round(seed_seconds, 3)}
+    report['dispatch'] = bench_dispatch(database_path, args.timeout)
+    report['database'] = {'size_bytes': database_size(database_path)}
+    report['mock_servers'] = {destination: dict(server.behaviour.counters) for destination, server in servers.items()}
+    for server in servers.values():
+        server.stop()
+
+    os.makedirs(args.output, exist_ok=True)
+    report_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{(report['commit'] or 'unknown')[:10]}.json"
+    report_path = os.path.join(args.output, report_name)
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print(json.dumps({key: report[key] for key in ('ingestion', 'seed', 'dispatch', 'database')}, indent=2))
+    print(f'Report written to {report_path}')
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(report, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    run()
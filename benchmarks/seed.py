@@ -0,0 +1,120 @@
+"""Seeds a kharon database with a realistic mix of requests.
+
+    python -m benchmarks.seed --database bench/kharon.db --rows 100000
+"""
+import argparse
+import datetime
+import itertools
+import json
+import random
+import time
+from uuid import uuid4
+import kh_db
+
+# Share of each kind of request in the seeded queue
+default_mix = {
+    'obtain_yti_details': 0.45,
+    'mention_case_in_yti': 0.15,
+    'delete_kh_yt_comment': 0.05,
+    'send_slack_notification': 0.25,
+    'create_pb_item': 0.10
+}
+
+insert_query = '''
+INSERT INTO kharon_requests (requestUUID, requestBody, headers, requestedFunction, requestFrom, requestTo,
+                             createdDatetime, TriggerObject)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class RequestFactory:
+    """Builds request bodies as Salesforce would send them. Issue ids follow a Zipf-like distribution,
+    so a few popular issues are referenced by many cases, as in production"""
+
+    def __init__(self, issues=2000, cases=20000, seed=0):
+        self.random = random.Random(seed)
+        self.issue_weights = list(itertools.accumulate(1 / rank for rank in range(1, issues + 1)))
+        self.issues = [f'SF-{number}' for number in range(1, issues + 1)]
+        self.cases = cases
+
+    def issue(self):
+        return self.random.choices(self.issues, cum_weights=self.issue_weights)[0]
+
+    def case(self):
+        return f'5003n{self.random.randrange(self.cases):013d}'
+
+    def obtain_yti_details(self):
+        return {'From': 'Salesforce', 'To': 'YouTrack', 'Function': 'obtain_yti_details',
+                'YTReadableId': self.issue(), 'TriggerObject': self.case()}
+
+    def mention_case_in_yti(self):
+        return {'From': 'Salesforce', 'To': 'YouTrack', 'Function': 'mention_case_in_yti',
+                'YTReadableId': self.issue(), 'TriggerObject': self.case(),
+                'CaseInformation': {'URL': 'https://example.my.salesforce.com/5003n00002TRjNMAA1',
+                                    'Reporter': 'Benchmark Engineer',
+                                    'CommentFromEngineer': 'Customer reports the issue on every backup run',
+                                    'CustomerInformation': {'Annual$': self.random.randrange(100, 100000),
+                                                            'CompanyName': 'Benchmark Company',
+                                                            'ContactEmail': 'customer@example.com',
+                                                            'TotalLicenses': self.random.randrange(1, 500)}}}
+
+    def delete_kh_yt_comment(self):
+        return {'From': 'Salesforce', 'To': 'YouTrack', 'Function': 'delete_kh_yt_comment',
+                'YTReadableId': self.issue(), 'TriggerObject': self.case()}
+
+    def send_slack_notification(self):
+        if self.random.random() < 0.5:
+            destination_type, destination = 'user', f'user{self.random.randrange(500)}'
+        else:
+            destination_type, destination = 'channel', self.random.choice(['missed-calls', 'escalations', 'support'])
+        return {'From': 'Salesforce', 'To': 'Slack', 'Function': 'send_slack_notification',
+                'notification_destination_type': destination_type, 'notification_destination': destination,
+                'notification_text': 'A missed call case has been created: [Link](https://example.com)',
+                'TriggerObject': self.case()}
+
+    def create_pb_item(self):
+        return {'From': 'Salesforce', 'To': 'ProductBoard', 'Function': 'create_pb_item',
+                'TriggerObject': self.case(),
+                'pbnote_data': {'title': 'Feature request from a customer', 'content': 'Benchmark note',
+                                'customer_email': 'customer@example.com', 'tags': ['benchmark']}}
+
+    def requests(self, count, mix=None):
+        mix = mix or default_mix
+        functions = list(mix)
+        for function in self.random.choices(functions, [mix[it] for it in functions], k=count):
+            yield getattr(self, function)()
+
+
+def seed(database_path, rows, mix=None, chunk_size=10000, seed_value=0):
+    """Inserts rows requests (in transactions of chunk_size rows), returns the seconds it took"""
+    con = kh_db.connect(database_path)
+    factory = RequestFactory(seed=seed_value)
+    started = time.perf_counter()
+    pending = []
+    for request_body in factory.requests(rows, mix):
+        moment = datetime.datetime.now().astimezone().isoformat()
+        pending.append((str(uuid4()), json.dumps(request_body), '{}', request_body['Function'],
+                        request_body['From'], request_body['To'], moment, request_body.get('TriggerObject')))
+        if len(pending) >= chunk_size:
+            with con:
+                con.executemany(insert_query, pending)
+            pending = []
+    if pending:
+        with con:
+            con.executemany(insert_query, pending)
+    con.close()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seeds kharon_requests with a benchmark request mix')
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    seconds = seed(args.database, args.rows, seed_value=args.seed)
+    print(f'Seeded {args.rows} requests in {seconds:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import kh_logging
+import request_schemas
+
+logger = kh_logging.get_logger('coalesce')
+
+
+# Fields of the payload naming what a request acts on. They are always part of the key, so requests about
+# different issues never make each other redundant, whatever key is configured
+identity_fields = {
+    'obtain_yti_details': ('YTReadableId',),
+    'populate_yti_details': ('YoutrackIssue.YTReadableId',),
+    'mention_case_in_yti': ('YTReadableId',),
+    'delete_kh_yt_comment': ('YTReadableId',)
+}
+
+
+def parse_list(value):
+    return [it.strip() for it in (value or '').split(',') if it.strip()]
+
+
+def body_value(request_body, path):
+    """Value of a field of the request, dotted paths reach into nested objects (YoutrackIssue.YTReadableId)"""
+    value = request_body
+    for part in path.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+class Coalescer:
+    """Collapses redundant requests of a claimed batch before it is dispatched, configured by the
+    [Coalescing] section of kh.ini:
+        supersede = obtain_yti_details, populate_yti_details
+            idempotent functions: of several requests with the same key only the latest one is executed
+        cancel = mention_case_in_yti > delete_kh_yt_comment
+            create > delete pairs: a delete queued after a create with the same key cancels both
+        key = TriggerObject
+            request fields (dotted paths allowed) naming the object of a request, '<function> key' per function.
+    The key of a request is its function (the create function for a delete), its From and To, the key fields
+    and the identity_fields of the function: with the default key two obtain_yti_details requests only
+    supersede each other if they share From, To, TriggerObject and YTReadableId.
+    Skipped requests are completed with supersededBy set to the request that made them redundant"""
+
+    def __init__(self, config):
+        self.config = config
+        self.supersede = set(parse_list(config.get('supersede')))
+        self.cancel = {}
+        for pair in parse_list(config.get('cancel')):
+            create, _, delete = pair.partition('>')
+            if create.strip() and delete.strip():
+                self.cancel[delete.strip()] = create.strip()
+        self.default_key = parse_list(config.get('key', 'TriggerObject'))
+
+    @property
+    def enabled(self):
+        return bool(self.supersede or self.cancel)
+
+    def key(self, request_body, function):
+        fields = parse_list(self.config.get(f'{function.lower()} key')) or self.default_key
+        values = tuple(body_value(request_body, field) for field in fields)
+        # Requests without any key value cannot be shown to be redundant
+        if all(value is None for value in values):
+            return None
+        identity = tuple(body_value(request_body, field) for field in identity_fields.get(function, ()))
+        return (request_body.get('From'), request_body.get('To')) + values + identity
+
+    def apply(self, kh_requests, status_batch):
+        """Returns the requests (RequestEnvelopes) of the batch that still have to be executed, in their original
+        order. The others are recorded as superseded in status_batch. Returns (kept, {outcome: count}).
+        Only the bodies of requests for functions named in the configuration are decoded"""
+        if not self.enabled:
+            return kh_requests, {}
+        skipped = {}
+        latest = {}
+        creates = {}
+        for position, it_request in enumerate(kh_requests):
+            function = it_request.function
+            if function not in self.supersede and function not in self.cancel \
+                    and function not in self.cancel.values():
+                continue
+            request_body = it_request.body
+            # An invalid request is dead-lettered, it must not take the place of the valid ones
+            if request_body is None or request_schemas.validate(request_body):
+                continue
+            if function in self.supersede:
+                key = self.key(request_body, function)
+                if key is not None:
+                    if (function, key) in latest:
+                        earlier = latest[(function, key)]
+                        skipped[kh_requests[earlier].request_uuid] = ('superseded', it_request.request_uuid)
+                    latest[(function, key)] = position
+            if function in self.cancel.values():
+                key = self.key(request_body, function)
+                if key is not None:
+                    creates.setdefault((function, key), []).append(position)
+            elif function in self.cancel:
+                create_function = self.cancel[function]
+                key = self.key(request_body, create_function)
+                open_creates = creates.get((create_function, key)) if key is not None else None
+                if open_creates:
+                    create_position = open_creates.pop()
+                    create_uuid = kh_requests[create_position].request_uuid
+                    skipped[create_uuid] = ('cancelled', it_request.request_uuid)
+                    skipped[it_request.request_uuid] = ('cancelled', create_uuid)
+        counts = {}
+        for request_uuid, (outcome, by_uuid) in skipped.items():
+            status_batch.supersede(request_uuid, by_uuid)
+            counts[outcome] = counts.get(outcome, 0) + 1
+            kh_logging.for_request(logger, request_uuid).info('Skipped, %s by %s', outcome, by_uuid)
+        return [it_request for it_request in kh_requests if it_request.request_uuid not in skipped], counts
@@ -0,0 +1,76 @@
+import argparse
+import datetime
+import kh_config
+import kh_db
+import wakeup
+
+replay_query = '''
+UPDATE kharon_requests SET Completed = 0, failedToExecute = 0, nextAttemptAt = NULL, lastError = NULL,
+                           workerId = NULL, leaseExpiresAt = NULL
+WHERE Completed = 2 AND requestUUID IN (SELECT requestUUID FROM kharon_dead_letters WHERE {condition})
+'''
+
+
+def selection(request_uuids=None, destination=None, function=None, error_class=None, since=None):
+    """Builds the WHERE condition on kharon_dead_letters for the given filters (all of them must match)"""
+    conditions, parameters = [], []
+    if request_uuids:
+        conditions.append('requestUUID IN (%s)' % ', '.join('?' * len(request_uuids)))
+        parameters.extend(request_uuids)
+    for column, value in (('requestTo', destination), ('requestedFunction', function), ('errorClass', error_class)):
+        if value:
+            conditions.append(f'{column} = ?')
+            parameters.append(value)
+    if since is not None:
+        conditions.append('deadLetteredAt >= ?')
+        parameters.append(since)
+    return ' AND '.join(conditions) or '1 = 1', parameters
+
+
+def list_dead_letters(con, **filters):
+    condition, parameters = selection(**filters)
+    return con.execute('SELECT requestUUID, requestTo, requestedFunction, TriggerObject, failedToExecute, errorClass, '
+                       f'lastError, deadLetteredAt FROM kharon_dead_letters WHERE {condition} ORDER BY Id',
+                       parameters).fetchall()
+
+
+def replay(con, **filters):
+    """Re-enqueues the selected dead-lettered requests with a fresh attempt budget, in one transaction.
+    Returns the number of requests re-enqueued"""
+    condition, parameters = selection(**filters)
+    with kh_db.immediate_transaction(con):
+        replayed = con.execute(replay_query.format(condition=condition), parameters).rowcount
+        con.execute(f'DELETE FROM kharon_dead_letters WHERE {condition}', parameters)
+    return replayed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Lists or replays dead-lettered kharon requests')
+    parser.add_argument('command', choices=['list', 'replay'])
+    parser.add_argument('--uuid', action='append', dest='request_uuids', help='request UUID, can be repeated')
+    parser.add_argument('--to', dest='destination', help='only requests to this destination')
+    parser.add_argument('--function', help='only requests for this function')
+    parser.add_argument('--error-class', choices=['permanent', 'retryable', 'exhausted'])
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat,
+                        help='only requests dead-lettered at or after this ISO date/time')
+    parser.add_argument('--all', action='store_true', help='replay every dead-lettered request')
+    args = parser.parse_args(argv)
+    filters = {'request_uuids': args.request_uuids, 'destination': args.destination, 'function': args.function,
+               'error_class': args.error_class, 'since': args.since.timestamp() if args.since else None}
+    if args.command == 'replay' and not args.all and not any(filters.values()):
+        parser.error('replay needs a filter or --all')
+
+    config = kh_config.load_config()
+    con = kh_db.get_connection(config['Database information']['database_path'])
+    if args.command == 'list':
+        for row in list_dead_letters(con, **filters):
+            dead_lettered_at = datetime.datetime.fromtimestamp(row[7]).isoformat(timespec='seconds') if row[7] else ''
+            print('\t'.join(str(value) if value is not None else '' for value in row[:7] + (dead_lettered_at,)))
+    else:
+        print(f'Re-enqueued {replay(con, **filters)} requests')
+        if config.has_section('Dispatcher'):
+            wakeup.notify(config['Dispatcher'].get('wakeup socket'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import kh_config
+import retry_policy
+
+
+class HandlerRegistry:
+    """Keeps one long-lived handler (and its authenticated client) per destination across batches.
+    A handler is rebuilt only when its kh.ini section changes, and reconnected only when its session
+    has expired or a call was rejected with 401. Every request gets its own copy of the handler
+    (see RequestHandlerBase.for_request), so the registry can be shared between worker threads"""
+
+    def __init__(self, handler_association):
+        self.handler_association = handler_association
+        self.handlers = {}
+        self.locks = {}
+        self.stats_lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'rebuilds': 0, 'reconnects': 0}
+
+    def _count(self, counter):
+        with self.stats_lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.stats_lock:
+            return dict(self.counters)
+
+    def _lock(self, destination):
+        return self.locks.setdefault(destination, threading.Lock())
+
+    def get(self, request_body, request_uuid):
+        destination = request_body['To']
+        section = kh_config.load_section(destination)
+        with self._lock(destination):
+            cached = self.handlers.get(destination)
+            if cached is None or cached[0] != section:
+                self._count('misses' if cached is None else 'rebuilds')
+                handler = self.handler_association[destination](request_body, request_uuid)
+                self.handlers[destination] = (section, handler)
+            else:
+                self._count('hits')
+                handler = cached[1]
+                if handler.session_expired():
+                    handler.reconnect()
+                    self._count('reconnects')
+        return handler.for_request(request_body, request_uuid)
+
+    def reconnect(self, destination, stale_handler):
+        """Reconnects the shared handler, unless another worker already did it after stale_handler was issued"""
+        with self._lock(destination):
+            cached = self.handlers.get(destination)
+            if cached is not None and cached[1].connection_object is stale_handler.connection_object:
+                cached[1].reconnect()
+                self._count('reconnects')
+
+    def execute(self, request_body, request_uuid):
+        """Runs the requested function, reconnecting and retrying once if the destination rejected the session"""
+        handler = self.get(request_body, request_uuid)
+        try:
+            return handler.function_association[request_body['Function']]()
+        except Exception as e:
+            if not handler.is_auth_error(e):
+                raise
+            self.reconnect(request_body['To'], handler)
+            return self.get(request_body, request_uuid).function_association[request_body['Function']]()
+
+    @staticmethod
+    async def _call_async(handler, function):
+        if function in handler.async_function_association:
+            return await handler.async_function_association[function]()
+        return await retry_policy.to_thread(handler.function_association[function])
+
+    async def execute_async(self, request_body, request_uuid):
+        """execute() for the asyncio engine. Coroutine functions of the handler run on the event loop,
+        blocking ones (and handler construction, which may log in) in the loop's thread pool"""
+        handler = await asyncio.to_thread(self.get, request_body, request_uuid)
+        try:
+            return await self._call_async(handler, request_body['Function'])
+        except Exception as e:
+            if not handler.is_auth_error(e):
+                raise
+            await asyncio.to_thread(self.reconnect, request_body['To'], handler)
+            handler = await asyncio.to_thread(self.get, request_body, request_uuid)
+            return await self._call_async(handler, request_body['Function'])
+
+    def supports_batch(self, destination, function):
+        handler_class = self.handler_association.get(destination)
+        if handler_class is None or function not in handler_class.batch_association:
+            return False
+        try:
+            section = kh_config.load_section(destination)
+        except KeyError:
+            return False
+        return handler_class.batching_enabled(function, section)
+
+    def execute_batch(self, destination, function, batch):
+        """Runs a batch function on a list of (request_uuid, request_body), returns {request_uuid: (success, status)}
+        or {request_uuid: (success, status, error)} (or {request_uuid: success}, leaving the classification
+        of failures to the last status of the batch)"""
+        request_uuid, request_body = batch[0]
+        handler = self.get(request_body, request_uuid)
+        try:
+            return getattr(handler, handler.batch_association[function])(batch)
+        except Exception as e:
+            if not handler.is_auth_error(e):
+                raise
+            self.reconnect(destination, handler)
+            handler = self.get(request_body, request_uuid)
+            return getattr(handler, handler.batch_association[function])(batch)
@@ -0,0 +1,147 @@
+import asyncio
+import email.utils
+import threading
+import time
+import requests
+import kh_metrics
+import retry_policy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_async_sessions = {}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(Retry.DEFAULT_ALLOWED_METHODS)
+
+
+class KharonRetry(Retry):
+    """Retries 5xx responses for idempotent methods only, but 429 for every method:
+    a rate-limited request was never processed, so re-sending a POST cannot duplicate anything"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class TimeoutSession(requests.Session):
+    """requests.Session with a default (connect, read) timeout for every call"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def session_settings(config):
+    return (float(config.get('connect timeout', 5)),
+            float(config.get('read timeout', 30)),
+            int(config.get('pool size', 10)),
+            int(config.get('max retries', 3)),
+            float(config.get('backoff factor', 0.5)))
+
+
+def metrics_hook(destination):
+    def record_response(response, *args, **kwargs):
+        retry = getattr(response.raw, 'retries', None)
+        kh_metrics.observe_external_call(destination, response.elapsed.total_seconds(), response.status_code,
+                                         len(retry.history) if retry is not None else 0)
+    return record_response
+
+
+def status_hook(response, *args, **kwargs):
+    retry_policy.record_status(response.status_code)
+
+
+def build_session(settings, destination=None):
+    connect_timeout, read_timeout, pool_size, max_retries, backoff_factor = settings
+    retry = KharonRetry(total=max_retries,
+                        connect=max_retries,
+                        read=max_retries,
+                        status=max_retries,
+                        status_forcelist=RETRY_STATUSES,
+                        backoff_factor=backoff_factor,
+                        respect_retry_after_header=True,
+                        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+    session = TimeoutSession((connect_timeout, read_timeout))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(status_hook)
+    if destination is not None:
+        session.hooks['response'].append(metrics_hook(destination))
+    return session
+
+
+def get_session(destination, config):
+    """Returns the keep-alive session shared by every handler of a destination.
+    Reads 'connect timeout', 'read timeout', 'pool size', 'max retries' and 'backoff factor'
+    from the destination's kh.ini section; a new session is built only when these change"""
+    settings = session_settings(config)
+    with _sessions_lock:
+        if destination not in _sessions or _sessions[destination][0] != settings:
+            _sessions[destination] = (settings, build_session(settings, destination))
+        return _sessions[destination][1]
+
+
+def retry_after_seconds(value):
+    """Parses a Retry-After header given either in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class AsyncSession:
+    """httpx.AsyncClient with the retry policy of the synchronous sessions (see KharonRetry)"""
+
+    def __init__(self, settings, destination=None):
+        import httpx
+        connect_timeout, read_timeout, pool_size, max_retries, backoff_factor = settings
+        self.httpx = httpx
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.destination = destination
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                                        limits=httpx.Limits(max_connections=pool_size,
+                                                            max_keepalive_connections=pool_size),
+                                        transport=httpx.AsyncHTTPTransport(retries=max_retries))
+
+    async def request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            response = await self.client.request(method, url, **kwargs)
+            retryable = response.status_code == 429 or \
+                (response.status_code in RETRY_STATUSES and method.upper() in IDEMPOTENT_METHODS)
+            if not retryable or attempt >= self.max_retries:
+                retry_policy.record_status(response.status_code)
+                if self.destination is not None:
+                    kh_metrics.observe_external_call(self.destination, time.monotonic() - started,
+                                                     response.status_code, attempt)
+                return response
+            delay = retry_after_seconds(response.headers.get('Retry-After'))
+            if delay is None:
+                delay = self.backoff_factor * (2 ** attempt)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+def get_async_session(destination, config):
+    """Returns the AsyncSession of a destination for the running event loop (httpx clients are bound to one loop)"""
+    settings = session_settings(config)
+    loop = asyncio.get_running_loop()
+    cached = _async_sessions.get(destination)
+    if cached is None or cached[0] != settings or cached[1] is not loop:
+        cached = _async_sessions[destination] = (settings, loop, AsyncSession(settings, destination))
+    return cached[2]
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+import kh_db
+
+
+class PendingGroup:
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitWriter:
+    """Buffers rows for kharon_requests and inserts them from a background thread in grouped transactions:
+    a group is committed once it holds max_rows rows or its oldest row has waited max_delay seconds.
+    submit() returns only after the group holding the rows has been committed (synchronous=FULL on the
+    writer connection), so callers can acknowledge a request as soon as it returns"""
+
+    def __init__(self, database_path, insert_query, max_rows=200, max_delay=0.01, on_flush=None):
+        self.database_path = database_path
+        self.insert_query = insert_query
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='kh-group-commit', daemon=True)
+        self.thread.start()
+
+    def submit(self, rows, timeout=30):
+        """Queues rows (dicts keyed by the insert query's parameters) and waits until they are durable"""
+        group = PendingGroup(rows)
+        self.pending.put(group)
+        if not group.done.wait(timeout):
+            raise TimeoutError('Group commit did not complete in time')
+        if group.error is not None:
+            raise group.error
+        return True
+
+    def _collect(self):
+        groups = [self.pending.get()]
+        row_count = len(groups[0].rows)
+        deadline = time.monotonic() + self.max_delay
+        while row_count < self.max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                group = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            groups.append(group)
+            row_count += len(group.rows)
+        return groups
+
+    def _connect(self):
+        con = kh_db.connect(self.database_path)
+        con.execute('PRAGMA synchronous = FULL')
+        return con
+
+    def _run(self):
+        con = None
+        while True:
+            groups = self._collect()
+            if con is None:
+                try:
+                    con = self._connect()
+                except Exception as e:
+                    # E.g. the database is locked by a migration: fail these groups, connect again for the next
+                    for group in groups:
+                        group.error = e
+                        group.done.set()
+                    continue
+            try:
+                with con:
+                    con.executemany(self.insert_query, [row for group in groups for row in group.rows])
+            except Exception:
+                # Do not fail every caller because of one bad group: commit the groups one by one instead
+                for group in groups:
+                    try:
+                        with con:
+                            con.executemany(self.insert_query, group.rows)
+                    except Exception as e:
+                        group.error = e
+            for group in groups:
+                group.done.set()
+            if self.on_flush is not None:
+                self.on_flush()
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+import kh_metrics
+
+cache_events = kh_metrics.counter('kharon_issue_cache_events_total',
+                                  'Issue details cache hits, misses, coalesced lookups, revalidations and evictions')
+
+# Returned by a loader when the destination answered 304 Not Modified to a conditional request
+NOT_MODIFIED = object()
+
+
+class CacheEntry:
+    __slots__ = ('value', 'etag', 'last_modified', 'fetched_at')
+
+    def __init__(self, value, etag=None, last_modified=None):
+        self.value = value
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+
+
+class _Flight:
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class IssueDetailsCache:
+    """Bounded LRU cache of parsed issue details with a TTL, and single-flight loading: concurrent lookups of
+    the same key wait for the one lookup already in flight instead of calling the destination again.
+    Expired entries are kept (until evicted) so the loader can revalidate them with a conditional request.
+    A loader gets the expired entry (or None) and returns a CacheEntry, NOT_MODIFIED, or None on failure,
+    which is not cached"""
+
+    def __init__(self, name, ttl=60, max_size=1000):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.inflight_async = {}
+        self.counters = {'hits': 0, 'misses': 0, 'coalesced': 0, 'revalidated': 0, 'evictions': 0}
+
+    def _count(self, counter):
+        # Called with self.lock held
+        self.counters[counter] += 1
+        cache_events.inc(cache=self.name, event=counter)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.entries))
+
+    def _lookup(self, key):
+        """Returns (fresh value or None, entry to revalidate or None). Called with self.lock held"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            if time.monotonic() - entry.fetched_at < self.ttl:
+                self._count('hits')
+                return entry.value, None
+        return None, entry
+
+    def _store(self, key, stale, result):
+        with self.lock:
+            if result is NOT_MODIFIED:
+                self._count('revalidated')
+                stale.fetched_at = time.monotonic()
+                return stale.value
+            if result is None:
+                return None
+            if self.ttl > 0:
+                self.entries[key] = result
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self._count('evictions')
+            return result.value
+
+    def get(self, key, load):
+        """Returns the value for key, calling load(stale_entry) unless it is cached or already being loaded"""
+        with self.lock:
+            value, stale = self._lookup(key)
+            if value is not None:
+                return value
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+                self._count('misses')
+            else:
+                self._count('coalesced')
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = self._store(key, stale, load(stale))
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.event.set()
+
+    async def get_async(self, key, load):
+        """get() for coroutine loaders, coalescing lookups made on the same event loop"""
+        with self.lock:
+            value, stale = self._lookup(key)
+            if value is not None:
+                return value
+            flight = self.inflight_async.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight_async[key] = asyncio.get_running_loop().create_future()
+                self._count('misses')
+            else:
+                self._count('coalesced')
+        if not leader:
+            return await asyncio.shield(flight)
+        try:
+            value = self._store(key, stale, await load(stale))
+            flight.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            # Retrieved here so that a flight nobody else waited for does not log "exception never retrieved"
+            flight.exception()
+            raise
+        finally:
+            with self.lock:
+                del self.inflight_async[key]
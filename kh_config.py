@@ -0,0 +1,30 @@
+import configparser
+import os
+import threading
+
+config_path = 'kh.ini'
+_config_lock = threading.Lock()
+_config_cache = {'path': None, 'mtime': None, 'config': None}
+
+
+def load_config(path=None, force=False):
+    """Returns the parsed kh.ini. The file is only parsed again once its modification time changes
+    (or when force is set), so handlers can ask for their section as often as they like"""
+    path = path or config_path
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    with _config_lock:
+        if force or _config_cache['config'] is None or _config_cache['path'] != path \
+                or _config_cache['mtime'] != mtime:
+            config = configparser.ConfigParser()
+            config.read(path)
+            _config_cache.update(path=path, mtime=mtime, config=config)
+        return _config_cache['config']
+
+
+def load_section(section_name, path=None):
+    """Returns a copy of a kh.ini section as a plain dict, raises KeyError if the section does not exist"""
+    config = load_config(path)
+    return {key: config[section_name][key] for key in config[section_name]}
@@ -0,0 +1,255 @@
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+# Applied to every connection. WAL lets the Flask writer and the dispatcher work at the same time,
+# synchronous=NORMAL is durable across application crashes in WAL mode and saves an fsync per commit
+connection_pragmas = [
+    # Only takes effect for new databases (older ones need one VACUUM, see retention.full_vacuum);
+    # lets retention hand the pages of archived rows back with PRAGMA incremental_vacuum
+    'PRAGMA auto_vacuum = INCREMENTAL',
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 30000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -20000'
+]
+
+kharon_requests_schema = '''
+CREATE TABLE IF NOT EXISTS "kharon_requests"
+(
+    [Id] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    [requestUUID] VARCHAR(40)  NOT NULL,
+    [failedToExecute] INTEGER DEFAULT 0,
+    [requestedFunction] VARCHAR(40) NOT NULL,
+    [requestBody] NVARCHAR(6000),
+    [requestFrom] VARCHAR(40),
+    [requestTo] VARCHAR(40),
+    [referenceObjectId] VARCHAR(40),
+    [createdDatetime] TEXT,
+    [headers] TEXT,
+    [Completed] INTEGER DEFAULT 0,
+    [TriggerObject] NVARCHAR(60)
+)
+'''
+
+yt_comments_schema = '''
+CREATE TABLE IF NOT EXISTS "yt_comments"
+(
+    [trigger_object] NVARCHAR(40) NOT NULL,
+    [request_uuid] VARCHAR(40) NOT NULL,
+    [engineer_comment] NVARCHAR(6000) NOT NULL,
+    [created_datetime] TEXT,
+    [created_comment_id] VARCHAR(40),
+    [number] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    [created_comment_path] NVARCHAR(60) NOT NULL,
+    [trigger_yt_id] NVARCHAR(50),
+    [status] INTEGER DEFAULT 0
+)
+'''
+
+# Requests that failed permanently or ran out of attempts. The request itself stays in kharon_requests
+# (with Completed = 2), dead_letters.py re-enqueues it from there
+kharon_dead_letters_schema = '''
+CREATE TABLE IF NOT EXISTS "kharon_dead_letters"
+(
+    [Id] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    [requestUUID] VARCHAR(40) NOT NULL,
+    [requestedFunction] VARCHAR(40),
+    [requestTo] VARCHAR(40),
+    [TriggerObject] NVARCHAR(60),
+    [failedToExecute] INTEGER,
+    [errorClass] VARCHAR(20),
+    [lastError] TEXT,
+    [createdDatetime] TEXT,
+    [deadLetteredAt] REAL
+)
+'''
+
+dead_letter_insert_query = '''
+INSERT INTO kharon_dead_letters (requestUUID, requestedFunction, requestTo, TriggerObject, failedToExecute,
+                                 errorClass, lastError, createdDatetime, deadLetteredAt)
+SELECT requestUUID, requestedFunction, requestTo, TriggerObject, failedToExecute, ?, lastError, createdDatetime, ?
+FROM kharon_requests WHERE requestUUID = ?
+'''
+
+
+def add_missing_columns(con, table, columns):
+    existing = {row[1] for row in con.execute(f'PRAGMA table_info({table})')}
+    for column, column_type in columns.items():
+        if column not in existing:
+            con.execute(f'ALTER TABLE {table} ADD COLUMN [{column}] {column_type}')
+
+
+def migration_baseline(con):
+    # Databases created by main.py lack TriggerObject, older yt_comments tables lack trigger_yt_id/status
+    con.execute(kharon_requests_schema)
+    add_missing_columns(con, 'kharon_requests', {'TriggerObject': 'NVARCHAR(60)'})
+    con.execute(yt_comments_schema)
+    add_missing_columns(con, 'yt_comments', {'trigger_yt_id': 'NVARCHAR(50)', 'status': 'INTEGER DEFAULT 0'})
+
+
+def migration_leases(con):
+    add_missing_columns(con, 'kharon_requests', {'workerId': 'VARCHAR(80)', 'leaseExpiresAt': 'REAL'})
+
+
+def migration_indexes(con):
+    con.execute('CREATE INDEX IF NOT EXISTS idx_kharon_requests_uuid ON kharon_requests (requestUUID)')
+    # Only unfinished rows are polled, so the index stays small while the table keeps growing
+    con.execute('CREATE INDEX IF NOT EXISTS idx_kharon_requests_pending '
+                'ON kharon_requests (createdDatetime) WHERE Completed = 0')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_kharon_requests_worker '
+                'ON kharon_requests (workerId) WHERE workerId IS NOT NULL')
+    # Covers find_latest_comment without touching the table
+    con.execute('CREATE INDEX IF NOT EXISTS idx_yt_comments_trigger '
+                'ON yt_comments (trigger_object, status, created_datetime, created_comment_path)')
+
+
+def migration_retry_schedule(con):
+    add_missing_columns(con, 'kharon_requests', {'nextAttemptAt': 'REAL', 'lastError': 'TEXT'})
+    con.execute(kharon_dead_letters_schema)
+    con.execute('CREATE INDEX IF NOT EXISTS idx_kharon_dead_letters_uuid ON kharon_dead_letters (requestUUID)')
+    # Rows that used up their three attempts used to stay pending forever
+    exhausted = [row[0] for row in con.execute('SELECT requestUUID FROM kharon_requests '
+                                               'WHERE Completed = 0 AND failedToExecute >= 3')]
+    con.executemany(dead_letter_insert_query, [('exhausted', time.time(), request_uuid) for request_uuid in exhausted])
+    con.execute('UPDATE kharon_requests SET Completed = 2 WHERE Completed = 0 AND failedToExecute >= 3')
+
+
+def migration_stages(con):
+    # stageBody holds the next stage of a multi-stage request once the previous one succeeded, so a retry
+    # resumes there; parentUUID links the rows a stage fanned out to
+    add_missing_columns(con, 'kharon_requests', {'stageBody': 'TEXT', 'stage': 'INTEGER DEFAULT 0',
+                                                 'parentUUID': 'VARCHAR(40)'})
+    con.execute('CREATE INDEX IF NOT EXISTS idx_kharon_requests_parent '
+                'ON kharon_requests (parentUUID) WHERE parentUUID IS NOT NULL')
+
+
+def migration_coalescing(con):
+    # Requests skipped by coalesce.Coalescer are completed with the request that made them redundant
+    add_missing_columns(con, 'kharon_requests', {'supersededBy': 'VARCHAR(40)'})
+
+
+def migration_priorities(con):
+    # 0 high, 1 normal, 2 bulk (see priorities.py); claims pick every priority's share from this index
+    add_missing_columns(con, 'kharon_requests', {'priority': 'INTEGER DEFAULT 1'})
+    con.execute('CREATE INDEX IF NOT EXISTS idx_kharon_requests_priority '
+                'ON kharon_requests (priority, createdDatetime) WHERE Completed = 0')
+
+
+def migration_trigger_order(con):
+    # Looks up the older unfinished rows of a TriggerObject, see request_queue.pending_condition
+    con.execute('CREATE INDEX IF NOT EXISTS idx_kharon_requests_trigger '
+                'ON kharon_requests (TriggerObject, createdDatetime) WHERE Completed = 0')
+
+
+# Append only: the position of a migration in this list is the schema version it produces
+migrations = [
+    migration_baseline,
+    migration_leases,
+    migration_indexes,
+    migration_retry_schedule,
+    migration_stages,
+    migration_coalescing,
+    migration_priorities,
+    migration_trigger_order
+]
+
+_migrated_paths = set()
+_migration_lock = threading.Lock()
+
+
+_local = threading.local()
+
+
+@contextmanager
+def immediate_transaction(con):
+    """Runs the block in a BEGIN IMMEDIATE transaction (write lock taken up front), committing on success"""
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    try:
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            yield con
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+    finally:
+        con.isolation_level = isolation_level
+
+
+def migrate(con):
+    """Brings the database to the latest schema version (PRAGMA user_version), returns that version"""
+    with immediate_transaction(con):
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(migrations[version:], start=version + 1):
+            migration(con)
+            con.execute(f'PRAGMA user_version = {number}')
+    return len(migrations)
+
+
+def partition_of(key, count):
+    """Partition (0 .. count - 1) of a TriggerObject, the same in every process (unlike hash())"""
+    return zlib.crc32(str(key).encode('utf-8')) % int(count)
+
+
+def connect(database_path, timeout=30, check_same_thread=True):
+    """Opens a connection with the kharon pragmas applied, migrating the database on first use in this process"""
+    con = sqlite3.connect(database_path, timeout=timeout, cached_statements=256, check_same_thread=check_same_thread)
+    con.create_function('kh_partition', 2, partition_of, deterministic=True)
+    for pragma in connection_pragmas:
+        con.execute(pragma)
+    if database_path not in _migrated_paths:
+        with _migration_lock:
+            if database_path not in _migrated_paths:
+                migrate(con)
+                _migrated_paths.add(database_path)
+    return con
+
+
+def get_connection(database_path):
+    """Returns the long-lived connection of the calling thread to database_path, opening it on first use.
+    Statements are compiled once per connection and reused from its statement cache"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    con = connections.get(database_path)
+    if con is None:
+        con = connections[database_path] = connect(database_path)
+    return con
+
+
+class ConnectionPool:
+    """Up to size long-lived connections to database_path, for callers that run on short-lived threads
+    (Flask serves every request on a new one), where get_connection would open a connection per call.
+    A connection is used by one thread at a time"""
+
+    def __init__(self, database_path, size=4):
+        self.database_path = database_path
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        with self.slots:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                con = connect(self.database_path, check_same_thread=False)
+            try:
+                yield con
+            finally:
+                if con.in_transaction:
+                    con.rollback()
+                self.idle.put(con)
+
+
+def close_connections():
+    """Closes the connections held by the calling thread"""
+    for con in getattr(_local, 'connections', {}).values():
+        con.close()
+    _local.connections = {}
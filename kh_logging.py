@@ -0,0 +1,89 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+
+root_logger_name = 'kharon'
+request_fields = ('requestUUID', 'destination', 'function')
+_listener = None
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per line, carrying requestUUID/destination/function when the record has them"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in request_fields:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler.prepare folds the traceback into the message; this keeps it in exc_text instead,
+    so JsonLineFormatter writes it to the 'exception' field"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def setup_logging(config=None):
+    """Routes every 'kharon.*' logger through a queue to a background thread writing rotated JSON lines.
+    Reads the [Logging] section of kh.ini (as a dict): 'log file' (kharon.log), 'max bytes' (10 MB),
+    'backup count' (5), 'level' (INFO) and '<module> level' for single modules, e.g. 'handlers level = DEBUG'"""
+    global _listener
+    config = config or {}
+    stop_logging()
+    file_handler = logging.handlers.RotatingFileHandler(config.get('log file', 'kharon.log'),
+                                                        maxBytes=int(config.get('max bytes', 10 * 1024 * 1024)),
+                                                        backupCount=int(config.get('backup count', 5)),
+                                                        encoding='utf-8')
+    file_handler.setFormatter(JsonLineFormatter())
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger(root_logger_name)
+    root.handlers = [JsonQueueHandler(log_queue)]
+    root.propagate = False
+    root.setLevel(config.get('level', 'INFO').upper())
+    for key, value in config.items():
+        if key.endswith(' level'):
+            get_logger(key[:-len(' level')].strip()).setLevel(value.upper())
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def stop_logging():
+    """Flushes the queued records and stops the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name):
+    return logging.getLogger(f'{root_logger_name}.{name}')
+
+
+def for_request(logger, request_uuid, destination=None, function=None):
+    """A logger adapter that stamps every record with the request it is about"""
+    return logging.LoggerAdapter(logger, {'requestUUID': request_uuid, 'destination': destination,
+                                          'function': function})
@@ -0,0 +1,207 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600)
+
+# The request function being executed by the current thread / task, used to label external calls
+current_function = contextvars.ContextVar('kharon_current_function', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((key, value) for key, value in labels.items() if value is not None))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f'{self.name}{_format_labels(key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            state = self.values[key]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _render_value(self, key, value):
+        bucket_counts, total, count = value
+        lines = [f'{self.name}_bucket{_format_labels(key + (("le", _format_value(float(bound))),))} {bucket_count}'
+                 for bound, bucket_count in zip(self.buckets, bucket_counts)]
+        lines.append(f'{self.name}_bucket{_format_labels(key + (("le", "+Inf"),))} {count}')
+        lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, metric_class, name, documentation, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, documentation, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation):
+        return self._get(Counter, name, documentation)
+
+    def gauge(self, name, documentation):
+        return self._get(Gauge, name, documentation)
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, buckets=buckets)
+
+    def render(self):
+        """The Prometheus text exposition of every metric"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+external_call_seconds = histogram('kharon_external_call_seconds',
+                                  'Latency of the final attempt of calls to external destinations')
+external_retries = counter('kharon_external_retries_total',
+                           'Retries of external calls (429/5xx/connection errors) by destination and function')
+
+
+def observe_external_call(destination, seconds, status=None, retries=0):
+    function = current_function.get()
+    external_call_seconds.observe(seconds, destination=destination, function=function, status=status)
+    if retries:
+        external_retries.inc(retries, destination=destination, function=function)
+
+
+@contextmanager
+def external_call(destination):
+    """Times an external call that does not go through http_session (e.g. the Slack SDK)"""
+    started = time.monotonic()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        observe_external_call(destination, time.monotonic() - started, status)
+
+
+@contextmanager
+def function_context(function):
+    """Labels the external calls made inside the block with the request function"""
+    token = current_function.set(function)
+    try:
+        yield
+    finally:
+        current_function.reset(token)
+
+
+def _add_labels(sample, labels):
+    """Adds pre-formatted labels ('worker="0"') to one sample line of an exposition"""
+    name_end = min(position for position in (sample.find('{'), sample.find(' '), len(sample)) if position >= 0)
+    if sample[name_end:name_end + 1] == '{':
+        separator = '' if sample[name_end + 1:name_end + 2] == '}' else ','
+        return f'{sample[:name_end + 1]}{labels}{separator}{sample[name_end + 1:]}'
+    return f'{sample[:name_end]}{{{labels}}}{sample[name_end:]}'
+
+
+def merge_expositions(expositions):
+    """Merges the expositions of several processes into one, with a single HELP/TYPE header per metric.
+    expositions is a list of (text, labels): labels (e.g. {'worker': '0'}) are added to every sample of text"""
+    families = {}
+    for text, labels in expositions:
+        extra = ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+        family = None
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith('#'):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in {'HELP', 'TYPE'}:
+                    family = families.setdefault(parts[2], {'header': {}, 'samples': []})
+                    family['header'].setdefault(parts[1], line)
+                continue
+            if family is None:
+                family = families.setdefault(line.split('{', 1)[0].split(' ', 1)[0], {'header': {}, 'samples': []})
+            family['samples'].append(_add_labels(line, extra) if extra else line)
+    lines = []
+    for family in families.values():
+        lines.extend(family['header'][kind] for kind in ('HELP', 'TYPE') if kind in family['header'])
+        lines.extend(family['samples'])
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path, content=None):
+    """Atomically writes the exposition (of this process' registry by default) to path"""
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(registry.render() if content is None else content)
+    os.replace(temporary_path, path)
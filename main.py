@@ -1,9 +1,26 @@
 import sqlite3
 import configparser
 from request_handler_base import SalesforceRequestHandler, YoutrackRequestHandler, SlackRequestHandler, ProductBoardRequestHandler
+import request_handler_base
+from handler_registry import HandlerRegistry
+from request_queue import RequestQueue, StatusBatch
+from wakeup import DispatcherWakeup
+from async_engine import AsyncDispatcher
+from coalesce import Coalescer
+import kh_logging
+import kh_metrics
+import retry_policy
+import request_schemas
+import priorities
+import retention
+import kh_config
 import datetime
 import json
+import os
+import signal
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 handler_association = {
     'Salesforce': SalesforceRequestHandler,
@@ -11,128 +28,538 @@ handler_association = {
     'Slack': SlackRequestHandler,
     'ProductBoard': ProductBoardRequestHandler
 }
-global_request_handlers = {
-
-}
+request_handlers = HandlerRegistry(handler_association)
+# Outcome of the requests of the current batch, committed together by RequestQueue.finish
+request_status = StatusBatch()
 db_cfg = {}
+dispatcher_cfg = {}
+logging_cfg = {}
+metrics_cfg = {}
+retention_cfg = {}
+coalescing_cfg = {}
+# (index, count) of this worker when started by supervisor.py
+worker_partition = None
+metrics_written_at = 0
+retention_ran_at = time.monotonic()
+
+queue_wait_seconds = kh_metrics.histogram('kharon_queue_wait_seconds',
+                                          'Time from createdDatetime until processing of the request started')
+handler_seconds = kh_metrics.histogram('kharon_handler_seconds',
+                                       'Execution time of handler functions by destination and function')
+batch_sizes = kh_metrics.histogram('kharon_batch_size', 'Claimed batches and executed batch calls by size',
+                                   buckets=(1, 5, 10, 25, 50, 100, 200, 500, 1000))
+requests_total = kh_metrics.counter('kharon_requests_total', 'Processed requests by destination, function and outcome')
+queue_depth = kh_metrics.gauge('kharon_queue_depth', 'Unfinished requests by priority')
+registry_events = kh_metrics.gauge('kharon_handler_registry_events', 'Handler registry hits, misses and reconnects')
+
+
+logger = kh_logging.get_logger('dispatcher')
+validation_logger = kh_logging.get_logger('validation')
 
 
-db_schema = '''
-CREATE TABLE IF NOT EXISTS "kharon_requests"
-(
-    [Id] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-    [requestUUID] VARCHAR(40)  NOT NULL,
-    [failedToExecute] INTEGER DEFAULT 0,
-    [requestedFunction] VARCHAR(40) NOT NULL,
-    [requestBody] NVARCHAR(6000),
-    [requestFrom] VARCHAR(40),
-    [requestTo] VARCHAR(40),
-    [referenceObjectId] VARCHAR(40),
-    [createdDatetime] TEXT,
-    [headers] TEXT,
-    [Completed] INTEGER DEFAULT 0);
-'''
+def request_log(request_uuid, request_body=None, log=logger):
+    request_body = request_body if isinstance(request_body, dict) else {}
+    return kh_logging.for_request(log, request_uuid, request_body.get('To'), request_body.get('Function'))
 
 
-def dbg(debug_output, log_type='debug'):
-    with open(log_type+'.txt', 'a+') as debug:
-        debug.write(debug_output)
+def request_errors(request_uuid, request_body, raw_body=None):
+    """Checks a decoded request against request_schemas, logs and returns its problems (empty if valid)"""
+    errors = request_schemas.validate(request_body)
+    if errors:
+        request_log(request_uuid, request_body, log=validation_logger).info(
+            'Invalid request: %s\nRequest body:\n%s', '; '.join(errors), raw_body or request_body)
+    return errors
 
 
 def validate_request(request_uuid, request_body):
-    try:
-        json_req = json.loads(request_body)
-    except Exception as e:
-        dbg(f'{request_uuid}|INFO|Error when parsing request JSON\n{str(e)}\nRequest body:\n'
-            f'{request_body}\n', 'request_validation')
-        return False
-    sender, rcpt, fn = json_req.get('From'), json_req.get('To'), json_req.get('Function')
-    return sender and rcpt and fn
+    """Returns a stage produced by a handler as a dict if it is a valid request, None otherwise.
+    Stages are usually dicts already, older handlers return them as JSON"""
+    if not isinstance(request_body, dict):
+        try:
+            request_body, raw_body = json.loads(request_body), request_body
+        except Exception as e:
+            request_log(request_uuid, log=validation_logger).info('Error when parsing request JSON: %s\n'
+                                                                  'Request body:\n%s', e, request_body)
+            return None
+    else:
+        raw_body = None
+    return None if request_errors(request_uuid, request_body, raw_body) else request_body
 
 
 def load_config():
-    global db_cfg
+    global db_cfg, dispatcher_cfg, logging_cfg, metrics_cfg, retention_cfg, coalescing_cfg
     config = configparser.ConfigParser()
     config.read('kh.ini')
     db_cfg = {key: config['Database information'][key] for key in config['Database information']}
+    logging_cfg = {key: config['Logging'][key] for key in config['Logging']} if config.has_section('Logging') else {}
+    metrics_cfg = {key: config['Metrics'][key] for key in config['Metrics']} if config.has_section('Metrics') else {}
+    retention_cfg = {key: config['Retention'][key] for key in config['Retention']} \
+        if config.has_section('Retention') else {}
+    coalescing_cfg = {key: config['Coalescing'][key] for key in config['Coalescing']} \
+        if config.has_section('Coalescing') else {}
+    dispatcher_cfg = {key: config['Dispatcher'][key] for key in config['Dispatcher']} \
+        if config.has_section('Dispatcher') else {}
+    if worker_partition is not None:
+        logging_cfg['log file'] = worker_log_path(logging_cfg.get('log file', 'kharon.log'))
+        for section_cfg, key in ((metrics_cfg, 'metrics file'), (dispatcher_cfg, 'wakeup socket')):
+            if section_cfg.get(key):
+                section_cfg[key] = worker_path(section_cfg[key])
+
+
+def worker_path(path):
+    """Workers started by supervisor.py append their index to the metrics file and the wakeup socket, so they
+    do not write over each other (request_logger and wakeup.notify find them by the suffix)"""
+    return f'{path}.{worker_partition[0]}' if worker_partition is not None else path
 
 
-def process(kh_request):
-    global global_request_handlers
-    con = sqlite3.connect(db_cfg['database_path'])
-    cur = con.cursor()
-    if not validate_request(kh_request[0], kh_request[1]):
-        cur.execute('UPDATE kharon_requests SET failedToExecute = 3 WHERE requestUUID = ?',
-                    [kh_request[0]])
-        dbg(f'{kh_request[0]}|ERROR|Request was invalid, discarding')
-        con.commit()
-        con.close()
-        return False
-    request_uuid, request_body, failed_to_execute = kh_request[0], json.loads(kh_request[1]), kh_request[2]
-    if request_body['To'] not in global_request_handlers:
-        global_request_handlers[request_body['To']] = \
-            handler_association[request_body['To']](request_body, request_uuid)
+def worker_log_path(path):
+    """kharon.log becomes kharon-worker-N.log, as kharon.log.N names the backups of the rotating log"""
+    if worker_partition is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}-worker-{worker_partition[0]}{extension}'
+
+
+def dispatcher_flag(name):
+    return dispatcher_cfg.get(name, 'no').lower() in {'yes', 'true', '1'}
+
+
+def record_failure(request_uuid, request_body, failed_to_execute, error_class, error):
+    """Schedules another attempt with exponential backoff, or dead-letters the request if the error is
+    permanent or the request has used up the 'max attempts' of the [Dispatcher] section"""
+    request_body = request_body if isinstance(request_body, dict) else {}
+    attempts = int(failed_to_execute) + 1
+    if error_class == retry_policy.PERMANENT or attempts >= int(dispatcher_cfg.get('max attempts', 3)):
+        request_log(request_uuid, request_body).error('Failed to complete after %s attempts (%s, %s), dead-lettered',
+                                                      attempts, error_class, error)
+        request_status.dead_letter(request_uuid, attempts, error_class, error)
+        outcome = 'dead_lettered'
     else:
-        global_request_handlers[request_body['To']].update_request(request_body, request_uuid)
-    dbg(f'{request_uuid}|INFO|Starting processing for request \n')
-    result = global_request_handlers[request_body['To']].function_association[request_body['Function']]()
+        next_attempt_at = retry_policy.next_attempt_at(attempts, dispatcher_cfg)
+        request_log(request_uuid, request_body).error('Failed to complete (%s), attempt %s, retrying in %.0f seconds',
+                                                      error, attempts, next_attempt_at - time.time())
+        request_status.fail(request_uuid, attempts, next_attempt_at, error)
+        outcome = 'retry'
+    requests_total.inc(destination=request_body.get('To'), function=request_body.get('Function'), outcome=outcome)
+
+
+def start_request(envelope, deferred=None):
+    """Decodes and validates a request. Returns (request_uuid, request_body, failed_to_execute) if the
+    handler has to be called, None if the request was discarded as invalid or deferred to a batch.
+    If deferred is a list, requests for functions that support batching are appended to it as
+    (request_uuid, request_body, failed_to_execute), to be executed by process_batches"""
+    request_uuid, request_body, failed_to_execute = envelope.request_uuid, envelope.body, envelope.failed_to_execute
+    errors = request_errors(request_uuid, request_body, envelope.raw_body)
+    if errors:
+        record_failure(request_uuid, request_body, failed_to_execute, retry_policy.PERMANENT,
+                       'Invalid request: ' + '; '.join(errors))
+        return None
+    if deferred is not None and request_handlers.supports_batch(request_body['To'], request_body['Function']):
+        not_before = batch_window_end(envelope)
+        if not_before is not None:
+            request_log(request_uuid, request_body).info('Held until the batch window ends at %s',
+                                                         datetime.datetime.fromtimestamp(not_before).isoformat())
+            request_status.postpone(request_uuid, not_before)
+            return None
+        request_log(request_uuid, request_body).info('Deferred to batch')
+        deferred.append((request_uuid, request_body, failed_to_execute))
+        return None
+    request_log(request_uuid, request_body).info('Starting processing for request')
+    observe_queue_wait(envelope, request_body)
+    return request_uuid, request_body, failed_to_execute
+
+
+def batch_window_end(envelope):
+    """With '<function> batch window' (seconds) in the [Dispatcher] section, requests for a batch function
+    created in the same window are held in the queue until it ends, so they become due (and are claimed
+    and batched) together. Returns the end of the window (Unix time) if it has not ended yet, else None"""
+    window = float(dispatcher_cfg.get(f'{str(envelope.function).lower()} batch window', 0))
+    if window <= 0 or not envelope.created_datetime:
+        return None
+    try:
+        created = datetime.datetime.fromisoformat(envelope.created_datetime).astimezone().timestamp()
+    except ValueError:
+        return None
+    window_end = (created // window + 1) * window
+    return window_end if window_end > time.time() else None
+
 
-    # This condition indicates a request that has more than one stage (needs to be processed further)
-    if validate_request(request_uuid, result):
-        return process([request_uuid, result, failed_to_execute])
+def observe_queue_wait(envelope, request_body):
+    # Only rows claimed from the queue carry createdDatetime, further stages do not
+    if envelope.created_datetime:
+        try:
+            created = datetime.datetime.fromisoformat(envelope.created_datetime).astimezone()
+        except ValueError:
+            return
+        queue_wait_seconds.observe(max((datetime.datetime.now().astimezone() - created).total_seconds(), 0),
+                                   destination=request_body['To'], function=request_body['Function'])
+
+
+def observe_handler(request_body, started):
+    handler_seconds.observe(time.monotonic() - started, destination=request_body['To'],
+                            function=request_body['Function'])
+
+
+def next_stages(request_uuid, result):
+    """Returns the stages a handler result asks for: a request (a dict, or JSON as older handlers return it)
+    continues the request, a list of requests fans out to all of them"""
+    if isinstance(result, (dict, str)):
+        result = [result]
+    if not isinstance(result, (list, tuple)):
+        return []
+    return [stage for stage in (validate_request(request_uuid, it) for it in result) if stage is not None]
+
+
+def record_result(envelope, request_body, result):
+    """Records the outcome of a handler call. Returns the envelope of the next stage if the result is one.
+    The next stage is checkpointed with the outcome of the batch, so a failure of a later stage is retried
+    from that stage. A result with several stages is queued as child rows and completes this request"""
+    request_uuid, failed_to_execute = envelope.request_uuid, envelope.failed_to_execute
+    stages = next_stages(request_uuid, result)
+    if len(stages) == 1:
+        request_status.checkpoint(request_uuid, stages[0])
+        return envelope.next_stage(stages[0])
+    if stages:
+        child_uuids = request_status.fan_out(request_uuid, stages, request_body.get('TriggerObject'))
+        request_log(request_uuid, request_body).info('Fanned out to %s', ', '.join(child_uuids))
 
     if result:
-        dbg(f'{request_uuid}|INFO|Successfully completed\n')
-        cur.execute('UPDATE kharon_requests SET Completed = 1 WHERE requestUUID = ?',
-                    [request_uuid])
+        request_log(request_uuid, request_body).info('Successfully completed')
+        request_status.complete(request_uuid)
+        requests_total.inc(destination=request_body['To'], function=request_body['Function'], outcome='completed')
     else:
-        dbg(f'{request_uuid}|ERROR|Failed to complete, currently at {failed_to_execute+1} retries')
-        cur.execute('UPDATE kharon_requests SET failedToExecute = ? WHERE requestUUID = ?',
-                    (failed_to_execute+1, request_uuid))
-    con.commit()
-    con.close()
+        record_failure(request_uuid, request_body, failed_to_execute, retry_policy.classify_result(),
+                       retry_policy.describe_failure())
+    return None
+
+
+def process(envelope, deferred=None):
+    """Executes a request and its further stages"""
+    while envelope:
+        started = start_request(envelope, deferred)
+        if started is None:
+            return False
+        request_uuid, request_body, failed_to_execute = started
+        with kh_metrics.function_context(request_body['Function']):
+            retry_policy.reset_status()
+            handler_started = time.monotonic()
+            result = request_handlers.execute(request_body, request_uuid)
+            observe_handler(request_body, handler_started)
+        envelope = record_result(envelope, request_body, result)
     return True
 
 
-def processing_loop():
-    load_config()
-    global global_request_handlers
+async def process_async(envelope, deferred=None):
+    """process() for the asyncio engine: coroutine handler functions are awaited on the event loop"""
+    while envelope:
+        started = start_request(envelope, deferred)
+        if started is None:
+            return False
+        request_uuid, request_body, failed_to_execute = started
+        with kh_metrics.function_context(request_body['Function']):
+            retry_policy.reset_status()
+            handler_started = time.monotonic()
+            result = await request_handlers.execute_async(request_body, request_uuid)
+            observe_handler(request_body, handler_started)
+        envelope = record_result(envelope, request_body, result)
+    return True
+
+
+def process_batches(deferred):
+    """Executes deferred requests with one batch call per destination and function,
+    then records the outcome of every request"""
+    batches = {}
+    for request_uuid, request_body, failed_to_execute in deferred:
+        batches.setdefault((request_body['To'], request_body['Function']), []).append(
+            (request_uuid, request_body, failed_to_execute))
+    for (destination, function), batch in batches.items():
+        logger.info('Executing batch of %s requests', len(batch),
+                    extra={'destination': destination, 'function': function})
+        batch_sizes.observe(len(batch), destination=destination, function=function)
+        error = None
+        retry_policy.reset_status()
+        try:
+            with kh_metrics.function_context(function):
+                handler_started = time.monotonic()
+                results = request_handlers.execute_batch(destination, function,
+                                                         [(request_uuid, request_body)
+                                                          for request_uuid, request_body, _ in batch])
+                handler_seconds.observe(time.monotonic() - handler_started, destination=destination,
+                                        function=function)
+        except Exception as e:
+            logger.exception('Exception while processing batch', extra={'destination': destination,
+                                                                        'function': function})
+            error = e
+            results = {}
+        error_class = retry_policy.classify_exception(error) if error else retry_policy.classify_result()
+        for request_uuid, request_body, failed_to_execute in batch:
+            # Batch functions report (success, status) or (success, status, error) per request,
+            # a plain success leaves it to the batch
+            outcome = results.get(request_uuid)
+            success, status, message = (outcome + (None,))[:3] if isinstance(outcome, tuple) else (outcome, False, None)
+            if success:
+                request_log(request_uuid, request_body).info('Successfully completed')
+                request_status.complete(request_uuid)
+                requests_total.inc(destination=destination, function=function, outcome='completed')
+            elif error is None and status is not False:
+                record_failure(request_uuid, request_body, failed_to_execute, retry_policy.classify_status(status),
+                               message or (f'HTTP {status}' if status is not None else 'Handler reported failure'))
+            else:
+                record_failure(request_uuid, request_body, failed_to_execute, error_class,
+                               retry_policy.describe_failure(error))
+
+
+def record_exception(envelope, e):
+    request_log(envelope.request_uuid).error('Exception while processing request\n%s',
+                                             getattr(e, "message", repr(e)), exc_info=e)
+    record_failure(envelope.request_uuid, envelope.body, envelope.failed_to_execute,
+                   retry_policy.classify_exception(e), retry_policy.describe_failure(e))
+
+
+def execute_request(envelope, deferred=None):
+    try:
+        process(envelope, deferred)
+    except Exception as e:
+        record_exception(envelope, e)
+
+
+async def execute_request_async(envelope, deferred=None):
+    try:
+        await process_async(envelope, deferred)
+    except Exception as e:
+        record_exception(envelope, e)
+
+
+def routing_key(envelope):
+    """Returns the destination lane and the ordering key of a request, without decoding its body.
+    Requests without a TriggerObject are ordered only against themselves"""
+    return envelope.destination, envelope.trigger_object or envelope.request_uuid
+
+
+class DispatchLanes:
+    """Executes a batch of requests concurrently on per-destination lanes.
+    Every destination ('To') gets its own thread pool, sized by '<destination> concurrency' in the [Dispatcher]
+    section of kh.ini (default concurrency), so a slow destination only stalls its own lane.
+    Requests sharing a TriggerObject form a chain and are executed one after another in batch order,
+    even when they go to different destinations"""
+
+    def __init__(self, config):
+        self.config = config
+        self.default_concurrency = int(config.get('default concurrency', 1))
+        self.lanes = {}
+        self.lanes_lock = threading.Lock()
+
+    def lane(self, destination):
+        with self.lanes_lock:
+            if destination not in self.lanes:
+                concurrency = int(self.config.get(f'{str(destination).lower()} concurrency',
+                                                  self.default_concurrency))
+                self.lanes[destination] = ThreadPoolExecutor(max_workers=max(concurrency, 1),
+                                                             thread_name_prefix=f'kh-{destination}')
+            return self.lanes[destination]
+
+    def run_batch(self, kh_requests, deferred=None):
+        chains = {}
+        for it_request in kh_requests:
+            destination, key = routing_key(it_request)
+            chains.setdefault(key, []).append((destination, it_request))
+        pending = [len(chains)]
+        pending_lock = threading.Lock()
+        batch_done = threading.Event()
+
+        def advance(chain):
+            if not chain:
+                with pending_lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        batch_done.set()
+                return
+            destination, it_request = chain[0]
+            future = self.lane(destination).submit(execute_request, it_request, deferred)
+            future.add_done_callback(lambda _: advance(chain[1:]))
+
+        if not chains:
+            return
+        for chain in chains.values():
+            advance(chain)
+        batch_done.wait()
+
+    def shutdown(self):
+        with self.lanes_lock:
+            for executor in self.lanes.values():
+                executor.shutdown(wait=True)
+            self.lanes = {}
+
+
+def write_metrics(queue=None):
+    """Writes the dispatcher metrics to [Metrics] 'metrics file' (at most every 'write interval' seconds),
+    where request_logger's /metrics endpoint picks them up"""
+    global metrics_written_at
+    if not metrics_cfg.get('metrics file') or \
+            time.monotonic() - metrics_written_at < float(metrics_cfg.get('write interval', 10)):
+        return
+    for event, count in request_handlers.stats().items():
+        registry_events.set(count, event=event)
+    if queue is not None:
+        try:
+            depth = queue.depth()
+        except sqlite3.Error as e:
+            logger.warning('Failed to read the queue depth: %r', e)
+            depth = {}
+        for name, priority in priorities.PRIORITIES.items():
+            queue_depth.set(depth.get(priority, 0), priority=name)
+    try:
+        kh_metrics.write_file(metrics_cfg['metrics file'])
+    except OSError as e:
+        logger.warning('Failed to write metrics file %s: %r', metrics_cfg['metrics file'], e)
+    metrics_written_at = time.monotonic()
+
+
+def run_retention():
+    """Archives finished requests every [Retention] 'run every minutes' (off by default), only called while
+    the dispatcher is idle. Set 'max rows per run' to bound how long one pass keeps the dispatcher busy"""
+    global retention_ran_at
+    # Under supervisor.py the workers share one database, the first one archives for all of them
+    if worker_partition is not None and worker_partition[0] != 0:
+        return
+    if not retention_cfg.get('run every minutes') or \
+            time.monotonic() - retention_ran_at < float(retention_cfg['run every minutes']) * 60:
+        return
+    try:
+        retention.run(kh_config.load_config())
+    except (sqlite3.Error, OSError) as e:
+        logger.error('Retention pass failed: %r', e)
+    retention_ran_at = time.monotonic()
+
+
+def start_engine():
+    """Returns the name of the configured dispatch engine and its lanes (None for the sync engine)"""
+    engine = dispatcher_cfg.get('engine', 'threads' if dispatcher_flag('concurrent') else 'sync').lower()
+    if engine == 'async':
+        if not request_handler_base.async_slack_available:
+            logger.warning('aiohttp is not installed, the async engine sends Slack notifications with the '
+                           'blocking client in its thread pool')
+        return engine, AsyncDispatcher(dispatcher_cfg, execute_request_async, routing_key)
+    if engine == 'threads':
+        return engine, DispatchLanes(dispatcher_cfg)
+    return engine, None
+
+
+def new_queue(worker_id=None):
+    return RequestQueue(db_cfg['database_path'], worker_id=worker_id,
+                        lease_seconds=float(dispatcher_cfg.get('lease seconds', 60)),
+                        batch_size=int(dispatcher_cfg.get('batch size', 100)),
+                        weights=priorities.parse_weights(dispatcher_cfg.get('priority weights')),
+                        partition=worker_partition)
+
+
+def new_wakeup():
+    return DispatcherWakeup(dispatcher_cfg.get('wakeup socket'),
+                            min_idle=float(dispatcher_cfg.get('min idle', 0.05)),
+                            max_idle=float(dispatcher_cfg.get('max idle', 1)))
+
+
+def finish_batch(queue, stop=None):
+    """Commits the outcome of the batch, retrying with backoff while the database refuses the transaction.
+    Gives up only when stop is set; the requests of the batch then run again once their leases expire"""
+    attempt = 0
     while True:
-        con = sqlite3.connect(db_cfg['database_path'])
-        if con:
-            cur = con.cursor()
-            query = 'SELECT requestUUID, requestBody, failedToExecute FROM kharon_requests ' \
-                    'WHERE Completed = 0 AND failedToExecute < 3 ORDER BY createdDatetime LIMIT 100'
-            cur.execute(query)
-            current_requests = cur.fetchall()
+        try:
+            queue.finish(request_status)
+            return True
+        except sqlite3.Error as e:
+            attempt += 1
+            logger.critical('Failed to commit the outcome of %s requests (attempt %s): %r', len(request_status),
+                            attempt, e)
+            if stop is not None and stop.is_set():
+                return False
+            time.sleep(retry_policy.backoff_seconds(attempt, base=1.0, cap=30.0))
 
-            if len(current_requests):
-                # rqh = handler_association[request_body['To']](request_body, request_uuid)
 
-                for it_request in current_requests:
-                    request_uuid, request_body = it_request[0], json.loads(it_request[1])
-                    # if request_body['To'] not in global_request_handlers:
-                    #     global_request_handlers[request_body['To']] = handler_association[request_body['To']](
-                    #         request_body, request_uuid)
-                    # else:
-                    #     global_request_handlers[request_body['To']].update_request(request_body, request_uuid)
-                    try:
-                        process(it_request)
-                    except Exception as e:
-                        dbg(f'{it_request[0]}|ERROR|'
-                            f'Exception while processing request\n{getattr(e,"message", repr(e))}\n')
-                        cur.execute('UPDATE kharon_requests SET failedToExecute = ? WHERE requestUUID = ?',
-                                    (int(it_request[2]) + 1, it_request[0]))
-                        con.commit()
-                global_request_handlers = {}
+def processing_loop(stop=None, partition=None, reload=None):
+    """Claims and executes batches of requests until stop (a threading.Event) is set, forever by default.
+    partition is the (index, count) of a worker started by supervisor.py, which only claims the requests
+    of its share of TriggerObjects. Setting reload (a threading.Event) re-reads kh.ini before the next batch"""
+    global worker_partition
+    worker_partition = partition
+    load_config()
+    kh_logging.setup_logging(logging_cfg)
+    engine, lanes = start_engine()
+    coalescer = Coalescer(coalescing_cfg)
+    queue = new_queue()
+    queue.start_heartbeat()
+    wakeup = new_wakeup()
+    logger.info('Dispatcher started as worker %s with the %s engine%s', queue.worker_id, engine,
+                f', partition {partition[0] + 1} of {partition[1]}' if partition is not None else '')
+    while stop is None or not stop.is_set():
+        if reload is not None and reload.is_set():
+            # Nothing is in flight between two batches: the last one has been executed and committed
+            reload.clear()
+            queue.stop_heartbeat()
+            if lanes:
+                lanes.shutdown()
+            wakeup.close()
+            load_config()
+            kh_config.load_config(force=True)
+            kh_logging.setup_logging(logging_cfg)
+            engine, lanes = start_engine()
+            coalescer = Coalescer(coalescing_cfg)
+            queue = new_queue(queue.worker_id)
+            queue.start_heartbeat()
+            wakeup = new_wakeup()
+            logger.info('Configuration reloaded, dispatching with the %s engine', engine)
+        try:
+            current_requests = queue.claim()
+        except sqlite3.Error as e:
+            logger.critical('Failed to claim requests from the database: %r', e)
+            load_config()
+            queue.database_path = db_cfg['database_path']
+            logger.info('Config reloaded due to connection error\nCurrent config:\n%s', db_cfg)
+            time.sleep(1)
+            continue
+
+        if len(current_requests):
+            wakeup.reset()
+            batch_sizes.observe(len(current_requests))
+            current_requests, skipped = coalescer.apply(current_requests, request_status)
+            for outcome, count in skipped.items():
+                requests_total.inc(count, outcome=outcome)
+            deferred = [] if dispatcher_flag('batching') else None
+            if lanes:
+                lanes.run_batch(current_requests, deferred)
             else:
-                time.sleep(1)
+                for it_request in current_requests:
+                    execute_request(it_request, deferred)
+            if deferred:
+                process_batches(deferred)
+            finish_batch(queue, stop)
+            logger.debug('Handler registry: %s', ', '.join(f'{k}={v}' for k, v in request_handlers.stats().items()))
         else:
-            dbg(f'{datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()}'
-                f'|CRITICAL|Failed to establish a database connection\n')
-            load_config()
-            dbg(f'{datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()}'
-                f'|INFO|Config reloaded due to connection error\nCurrent config:\n{db_cfg}')
+            run_retention()
+            wakeup.wait()
+        write_metrics(queue)
+    queue.stop_heartbeat()
+    if lanes:
+        lanes.shutdown()
+    wakeup.close()
+    if partition is not None and metrics_cfg.get('metrics file'):
+        try:
+            os.remove(metrics_cfg['metrics file'])
+        except OSError:
+            pass
+
+
+def run_worker(partition=None):
+    """Runs the dispatcher in this process. SIGTERM and SIGINT stop it once the current batch is finished,
+    SIGHUP reloads kh.ini before the next batch"""
+    stop = threading.Event()
+    reload = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload.set())
+    processing_loop(stop, partition, reload)
+
 
 if __name__ == "__main__":
-    processing_loop()
+    run_worker()
@@ -0,0 +1,65 @@
+import kh_config
+
+# Lower numbers are served first
+PRIORITIES = {'high': 0, 'normal': 1, 'bulk': 2}
+DEFAULT_PRIORITY = PRIORITIES['normal']
+DEFAULT_WEIGHTS = 'high: 70, normal: 25, bulk: 5'
+
+
+def parse_priority(value):
+    """Returns the priority number for a name ('high') or a number (0), None if value is neither"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value if value in PRIORITIES.values() else None
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in PRIORITIES:
+            return PRIORITIES[value]
+        if value.isdigit():
+            return parse_priority(int(value))
+    return None
+
+
+def priority_for(request_body, config=None):
+    """Priority of a request: 'Priority' from the payload, else the entry for its Function in the
+    [Priorities] section of kh.ini, else the 'default' entry of that section (normal)"""
+    priority = parse_priority(request_body.get('Priority'))
+    if priority is not None:
+        return priority
+    config = config if config is not None else kh_config.load_config()
+    section = config['Priorities'] if config.has_section('Priorities') else {}
+    function = str(request_body.get('Function', '')).lower()
+    for value in (section.get(function), section.get('default')):
+        priority = parse_priority(value)
+        if priority is not None:
+            return priority
+    return DEFAULT_PRIORITY
+
+
+def parse_weights(value):
+    """'high: 70, normal: 25, bulk: 5' -> {0: 70.0, 1: 25.0, 2: 5.0}"""
+    weights = {}
+    for item in (value or DEFAULT_WEIGHTS).split(','):
+        name, _, weight = item.partition(':')
+        priority = parse_priority(name)
+        if priority is not None and weight.strip():
+            weights[priority] = float(weight)
+    return weights
+
+
+def shares(batch_size, weights):
+    """Splits a batch between the priorities in proportion to their weights. Every priority with a weight
+    gets at least one row, so bulk work keeps moving however much urgent work is queued (a batch_size
+    below the number of weighted priorities is raised to it).
+    Returns [(priority, rows)] ordered by priority"""
+    total = sum(weight for weight in weights.values() if weight > 0)
+    if not total:
+        return []
+    rows = {priority: max(1, int(batch_size * weight / total))
+            for priority, weight in weights.items() if weight > 0}
+    # Rounding up to one row each can overshoot the batch: take the excess from the largest shares
+    while sum(rows.values()) > max(batch_size, len(rows)):
+        largest = max(rows, key=rows.get)
+        rows[largest] -= 1
+    return sorted(rows.items())
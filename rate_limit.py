@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+# Sustained requests per second for Slack's Web API rate limit tiers
+SLACK_TIER_RATES = {
+    1: 1 / 60,
+    2: 20 / 60,
+    3: 50 / 60,
+    4: 100 / 60
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket: holds up to capacity tokens, refilled at rate tokens per second"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Blocks until the requested number of tokens is available"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """Like acquire, but waits without blocking the event loop"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+class KeyedTokenBuckets:
+    """One TokenBucket per key (e.g. per Slack channel), created on first use"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, key):
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self.rate, self.capacity)
+            return self.buckets[key]
+
+    def acquire(self, key, tokens=1):
+        self.bucket(key).acquire(tokens)
+
+    async def acquire_async(self, key, tokens=1):
+        await self.bucket(key).acquire_async(tokens)
@@ -0,0 +1,60 @@
+import json
+
+_UNDECODED = object()
+
+
+class RequestEnvelope:
+    """A request claimed by the dispatcher (or a further stage of one). It is routed on the requestTo,
+    requestedFunction and TriggerObject columns; the JSON body is decoded at most once, when the coalescer
+    or the handler first needs it"""
+    __slots__ = ('request_uuid', 'destination', 'function', 'trigger_object', 'failed_to_execute',
+                 'created_datetime', '_raw_body', '_body')
+
+    def __init__(self, request_uuid, body, failed_to_execute=0, created_datetime=None, destination=None,
+                 function=None, trigger_object=None):
+        self.request_uuid = request_uuid
+        self.failed_to_execute = failed_to_execute
+        self.created_datetime = created_datetime
+        if isinstance(body, dict):
+            self._raw_body, self._body = None, body
+        else:
+            self._raw_body, self._body = body, _UNDECODED
+        if destination is None or function is None:
+            # Stages and rows without the routing columns can only be routed on their body
+            decoded = self.body or {}
+            destination, function = decoded.get('To'), decoded.get('Function')
+            trigger_object = trigger_object or decoded.get('TriggerObject')
+        self.destination = destination
+        self.function = function
+        self.trigger_object = trigger_object
+
+    @classmethod
+    def from_row(cls, row):
+        """Builds the envelope of a row returned by RequestQueue.claim"""
+        request_uuid, destination, function, trigger_object, request_body, stage_body, failed, created = row
+        if stage_body is not None:
+            return cls(request_uuid, stage_body, failed, created, trigger_object=trigger_object)
+        return cls(request_uuid, request_body, failed, created, destination, function, trigger_object)
+
+    @property
+    def body(self):
+        """The request as a dict, None if its JSON is not an object"""
+        if self._body is _UNDECODED:
+            try:
+                body = json.loads(self._raw_body)
+            except (TypeError, ValueError):
+                body = None
+            self._body = body if isinstance(body, dict) else None
+            if self._body is not None:
+                self._raw_body = None
+        return self._body
+
+    @property
+    def raw_body(self):
+        """The body as it was stored, for logging requests that cannot be decoded"""
+        return self._raw_body if self._raw_body is not None else self._body
+
+    def next_stage(self, stage_body):
+        """The envelope of a further stage (a validated dict) of this request"""
+        return RequestEnvelope(self.request_uuid, stage_body, self.failed_to_execute,
+                               trigger_object=stage_body.get('TriggerObject') or self.trigger_object)
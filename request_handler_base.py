@@ -1,87 +1,161 @@
-import configparser
-import requests
-from simple_salesforce import Salesforce, SalesforceResourceNotFound
+import asyncio
+import copy
 import json
 import datetime
+import importlib.util
 import io
 import zipfile
-import sqlite3
-from slack_sdk import WebClient
 import time
+import kh_config
+import kh_logging
+import kh_metrics
+import kh_db
+import http_session
+import retry_policy
+from rate_limit import KeyedTokenBuckets
+from slack_directory import SlackUserDirectory
+from issue_cache import IssueDetailsCache, CacheEntry, NOT_MODIFIED
 
 
-def dbg(debug_output):
-    with open('debug.txt', 'a+') as debug:
-        debug.write(debug_output)
+logger = kh_logging.get_logger('handlers')
+
+# slack_sdk's AsyncWebClient needs aiohttp. Without it the async engine posts Slack notifications with
+# the blocking client in its thread pool
+async_slack_available = importlib.util.find_spec('aiohttp') is not None
 
 
 class RequestHandlerBase:
+    # Functions that can be executed for many requests in one call: function name -> batch method name
+    batch_association = {}
+    # Coroutine versions of function_association entries, used by the asyncio engine when present
+    async_function_association = {}
+
     def __init__(self, resource_name, request_body, request_uuid):
         self.resource_name = resource_name
         self.is_json = None
         self.request = request_body
         self.requestId = request_uuid
         self.connection_object = None
-        config = configparser.ConfigParser()
-        config.read('kh.ini')
-        self.config = {}
+        self.connected_at = None
         try:
-            for x in config[resource_name]:
-                self.config[x] = config[resource_name][x]
+            self.config = kh_config.load_section(resource_name)
         except KeyError as e:
-            with open('debug.log', 'a+') as debug:
-                debug.write(f'{request_uuid}|'
-                            f'  Failed to extract configuration for resource {resource_name} -- invalid resource name')
+            self.log.error('Failed to extract configuration for resource %s -- invalid resource name', resource_name)
             raise
-        with open('debug.log', 'a+') as debug:
-            debug.write(f'{request_uuid}|'
-                        f'SUCCESS: loaded request handler configuration for {resource_name}')
+        self.http = http_session.get_session(resource_name, self.config)
+        self.async_clients = {}
+        self.log.info('Loaded request handler configuration for %s', resource_name)
+
+    @property
+    def log(self):
+        """Logger stamped with the request this handler is currently bound to"""
+        function = self.request.get('Function') if isinstance(self.request, dict) else None
+        return kh_logging.for_request(logger, self.requestId, self.resource_name, function)
 
     def update_request(self, request_body, request_uuid):
         self.request = request_body
         self.requestId = request_uuid
 
+    def connect(self):
+        pass
+
+    @staticmethod
+    def batching_enabled(function, config):
+        """Whether the batch_association entry of function is used when [Dispatcher] batching is on"""
+        return True
+
+    def async_http(self):
+        """The asyncio counterpart of self.http, only available where httpx is installed"""
+        return http_session.get_async_session(self.resource_name, self.config)
+
+    def reconnect(self):
+        self.connect()
+        self.connected_at = time.time()
+
+    def session_expired(self):
+        """True once the connection is older than 'session lifetime' (seconds) from the handler configuration"""
+        lifetime = self.config.get('session lifetime')
+        return bool(lifetime) and self.connected_at is not None \
+            and time.time() - self.connected_at > float(lifetime)
+
+    @staticmethod
+    def is_auth_error(exception):
+        """True if the exception means the destination rejected our session (HTTP 401)"""
+        response = getattr(exception, 'response', None)
+        status = getattr(exception, 'status', None) or getattr(response, 'status_code', None)
+        return status == 401
+
+    def for_request(self, request_body, request_uuid):
+        """Returns a shallow copy of this handler bound to a single request.
+        The copy shares the connection objects of this handler, so concurrent workers can each hold their own
+        request state without logging in again"""
+        handler = copy.copy(self)
+        handler.update_request(request_body, request_uuid)
+        handler.function_association = {name: getattr(handler, fn.__name__)
+                                         for name, fn in self.function_association.items()}
+        handler.async_function_association = {name: getattr(handler, fn.__name__)
+                                               for name, fn in self.async_function_association.items()}
+        return handler
+
 
 class ProductBoardRequestHandler(RequestHandlerBase):
     def __init__(self, request, request_uuid):
         super().__init__('ProductBoard', request, request_uuid)
         self.function_association = {'create_pb_item': self.create_pb_item}
+        self.async_function_association = {'create_pb_item': self.create_pb_item_async}
         self.headers = {'Authorization': f"Bearer {self.config['jwt']}", "Content-Type": "application/json"}
         self.api_endpoint = self.config['api_endpoint']
 
     def create_pb_item(self):
+        post_pb_item = self.http.post(url=self.api_endpoint,
+                                      data=json.dumps(self.build_pb_note()),
+                                      headers=self.headers)
+        return self.handle_pb_response(post_pb_item)
+
+    async def create_pb_item_async(self):
+        post_pb_item = await self.async_http().request('POST', self.api_endpoint,
+                                                      content=json.dumps(self.build_pb_note()),
+                                                      headers=self.headers)
+        return self.handle_pb_response(post_pb_item)
+
+    def build_pb_note(self):
         note_data = {}
-        with open('pb_debug.txt', 'w+') as pbdebug:
-            for it in self.request:
-                pbdebug.write(f"{it}:{self.request[it]}")
+        self.log.debug('ProductBoard request: %s', self.request)
         for it in self.request['pbnote_data']:
             note_data[it] = self.request['pbnote_data'][it]
-        post_pb_item = requests.post(url=self.api_endpoint,
-                                     data=json.dumps(note_data),
-                                     headers=self.headers)
-        with open('pb_debug_request.txt', 'w+') as pbdebug:
-            pbdebug.write(str(post_pb_item.status_code))
-            pbdebug.write(post_pb_item.response.text)
+        return note_data
+
+    def handle_pb_response(self, post_pb_item):
+        self.log.debug('ProductBoard response %s: %s', post_pb_item.status_code, post_pb_item.text)
         return post_pb_item.status_code == 201
 
+
 class SlackRequestHandler(RequestHandlerBase):
+    batch_association = {'send_slack_notification': 'send_slack_notification_batch'}
 
     def __init__(self, request, request_uuid):
         super().__init__('Slack', request, request_uuid)
         self.function_association = {'send_slack_notification': self.send_slack_notification}
-        self.connect()
-        self.user_list = self.obtain_slack_user_list()
+        if async_slack_available:
+            self.async_function_association = {'send_slack_notification': self.send_slack_notification_async}
+        self.reconnect()
+        self.user_directory = SlackUserDirectory(self.connection_object,
+                                                 path=self.config.get('user cache path', 'slack_users.db'),
+                                                 ttl=float(self.config.get('user cache ttl', 86400)),
+                                                 resync_interval=float(self.config.get('user resync interval', 300)))
+        # chat.postMessage allows about one message per second per channel, with short bursts
+        self.message_buckets = KeyedTokenBuckets(float(self.config.get('message rate', 1)),
+                                                 float(self.config.get('message burst', 1)))
 
     def connect(self):
+        # Destination SDKs are imported on first use, so a dispatcher only loads the ones it needs
+        from slack_sdk import WebClient
         if self.config != {}:
-            self.connection_object = WebClient(self.config['token'])
-
-    def obtain_slack_user_list(self):
-        slack_user_list = self.connection_object.users_list()
-        user_to_id = {}
-        for user in slack_user_list['members']:
-            user_to_id[user['name']] = user['id']
-        return user_to_id
+            self.connection_object = WebClient(self.config['token'],
+                                               base_url=self.config.get('api url', WebClient.BASE_URL),
+                                               timeout=int(float(self.config.get('read timeout', 30))))
+            if getattr(self, 'user_directory', None) is not None:
+                self.user_directory.client = self.connection_object
 
     def send_slack_notification(self):
         """
@@ -97,43 +171,160 @@ class SlackRequestHandler(RequestHandlerBase):
         }
         :return:
         """
-        time.sleep(1)
         if self.request['notification_destination_type'] == 'user':
-            if self.request['notification_destination'] in self.user_list:
+            user_id = self.user_directory.lookup(self.request['notification_destination'])
+            if user_id is None:
+                self.log.error('Slack user %s not found, user directory re-sync requested',
+                               self.request['notification_destination'])
+                return False
+            self.message_buckets.acquire(user_id)
+            with kh_metrics.external_call('Slack'):
                 self.connection_object.chat_postMessage(
-                    channel=self.user_list[self.request['notification_destination']],
+                    channel=user_id,
                     text=self.request['notification_text'])
         elif self.request['notification_destination_type'] == 'channel':
-            self.connection_object.chat_postMessage(
-                channel=self.request['notification_destination'],
-                text=self.request['notification_text'])
+            self.message_buckets.acquire(self.request['notification_destination'])
+            with kh_metrics.external_call('Slack'):
+                self.connection_object.chat_postMessage(
+                    channel=self.request['notification_destination'],
+                    text=self.request['notification_text'])
         return True
 
+    def async_slack(self):
+        if 'slack' not in self.async_clients:
+            from slack_sdk.web.async_client import AsyncWebClient
+            self.async_clients['slack'] = AsyncWebClient(self.config['token'],
+                                                         base_url=self.config.get('api url', AsyncWebClient.BASE_URL),
+                                                         timeout=int(float(self.config.get('read timeout', 30))))
+        return self.async_clients['slack']
+
+    async def send_slack_notification_async(self):
+        if self.request['notification_destination_type'] == 'user':
+            user_id = await retry_policy.to_thread(self.user_directory.lookup,
+                                                   self.request['notification_destination'])
+            if user_id is None:
+                self.log.error('Slack user %s not found, user directory re-sync requested',
+                               self.request['notification_destination'])
+                return False
+            channel = user_id
+        elif self.request['notification_destination_type'] == 'channel':
+            channel = self.request['notification_destination']
+        else:
+            return True
+        await self.message_buckets.acquire_async(channel)
+        with kh_metrics.external_call('Slack'):
+            await self.async_slack().chat_postMessage(channel=channel, text=self.request['notification_text'])
+        return True
+
+    @staticmethod
+    def batching_enabled(function, config):
+        # Without a digest, batching would only take notifications off the concurrent lanes
+        return config.get('digest', 'no').lower() in {'message', 'thread'}
+
+    def post_message(self, channel, text, thread_ts=None):
+        self.message_buckets.acquire(channel)
+        with kh_metrics.external_call('Slack'):
+            if thread_ts is None:
+                return self.connection_object.chat_postMessage(channel=channel, text=text)
+            return self.connection_object.chat_postMessage(channel=channel, text=text, thread_ts=thread_ts)
+
+    def digest_chunks(self, group):
+        """Splits the notifications of one destination into messages of at most 'digest max chars'
+        characters. Returns [(request_uuids, text)]; a notification longer than that is sent on its own"""
+        max_chars = int(self.config.get('digest max chars', 3500))
+        chunks = []
+        for request_uuid, request_body in group:
+            line = f"• {request_body['notification_text']}"
+            if chunks and len(chunks[-1][1]) + 1 + len(line) <= max_chars:
+                chunks[-1][0].append(request_uuid)
+                chunks[-1][1] += '\n' + line
+            else:
+                chunks.append([[request_uuid], line])
+        return chunks
+
+    def send_slack_notification_batch(self, batch):
+        """Sends the notifications of a batch grouped by destination, as configured by 'digest' in the [Slack]
+        section of kh.ini:
+            no (default): notifications are not batched, see batching_enabled
+            message: the notifications of a destination are joined into as few messages as 'digest max chars'
+                allows
+            thread: a '<count> notifications' message is posted, and the digest messages go into its thread
+        A notification only counts as sent once Slack accepted the message it is part of.
+        Takes a list of (request_uuid, request_body), returns {request_uuid: (success, status)}"""
+        mode = self.config.get('digest', 'no').lower()
+        results = {}
+        groups = {}
+        for request_uuid, request_body in batch:
+            if request_body['notification_destination_type'] == 'user':
+                channel = self.user_directory.lookup(request_body['notification_destination'])
+                if channel is None:
+                    kh_logging.for_request(logger, request_uuid, 'Slack', 'send_slack_notification').error(
+                        'Slack user %s not found, user directory re-sync requested',
+                        request_body['notification_destination'])
+                    results[request_uuid] = (False, None)
+                    continue
+            else:
+                channel = request_body['notification_destination']
+            groups.setdefault(channel, []).append((request_uuid, request_body))
+        for channel, group in groups.items():
+            chunks = self.digest_chunks(group) if mode in {'message', 'thread'} and len(group) > 1 \
+                else [([request_uuid], request_body['notification_text']) for request_uuid, request_body in group]
+            thread_ts = None
+            try:
+                if mode == 'thread' and len(group) > 1:
+                    thread_ts = self.post_message(channel, f'{len(group)} notifications')['ts']
+            except Exception as e:
+                if self.is_auth_error(e):
+                    raise
+                logger.error('Failed to start a digest thread in %s: %r', channel, e,
+                             extra={'destination': 'Slack', 'function': 'send_slack_notification'})
+                status = retry_policy.exception_status(e)
+                results.update((request_uuid, (False, status)) for request_uuid, _ in group)
+                continue
+            for request_uuids, text in chunks:
+                status = None
+                try:
+                    self.post_message(channel, text, thread_ts)
+                    sent = True
+                except Exception as e:
+                    if self.is_auth_error(e):
+                        raise
+                    logger.error('Failed to send %s notifications to %s: %r', len(request_uuids), channel, e,
+                                 extra={'destination': 'Slack', 'function': 'send_slack_notification'})
+                    sent, status = False, retry_policy.exception_status(e)
+                results.update((request_uuid, (sent, status)) for request_uuid in request_uuids)
+            if len(group) > 1:
+                logger.info('Sent %s notifications to %s in %s messages', len(group), channel, len(chunks),
+                            extra={'destination': 'Slack', 'function': 'send_slack_notification'})
+        return results
+
 
 class SalesforceRequestHandler(RequestHandlerBase):
+    batch_association = {'populate_yti_details': 'populate_yti_details_batch'}
 
     def __init__(self, request, request_uuid):
         super().__init__('Salesforce', request, request_uuid)
         self.function_association = {'populate_yti_details': self.populate_yti_details}
-        self.connect()
+        self.reconnect()
 
     def connect(self):
+        from simple_salesforce import Salesforce
         if self.config != {}:
             if 'sandbox' in self.config:
                 self.connection_object = Salesforce(username=self.config['username'],
                                                     password=self.config['password'],
                                                     security_token=self.config['security_token'],
-                                                    domain='test')
+                                                    domain='test',
+                                                    session=self.http)
             else:
                 self.connection_object = Salesforce(username=self.config['username'],
                                                      password=self.config['password'],
-                                                     security_token=self.config['security_token'])
+                                                     security_token=self.config['security_token'],
+                                                     session=self.http)
 
-    def populate_yti_details(self):
-        """This method takes a property map like and updates the associated YoutrackIssue__c object accordingly
-           Format:
-           {"YoutrackIssue":{"property_name":"property_value"}}"""
-        yti_details = self.request.get('YoutrackIssue')
+    @staticmethod
+    def prepare_yti_details(yti_details):
+        """Maps a YouTrack property map onto YoutrackIssue__c fields, returns the fields and the id to match on"""
         if 'old_issue_id' not in yti_details:
             prepared_yti_details = {k + '__c': v for k, v in yti_details.items()}
             correct_id = yti_details['YTReadableId']
@@ -143,6 +334,14 @@ class SalesforceRequestHandler(RequestHandlerBase):
         prepared_yti_details['Name'] = yti_details['YTReadableId']
         if 'project__c' not in prepared_yti_details:
             prepared_yti_details['project__c'] = yti_details['YTReadableId'].split('-')[0]
+        return prepared_yti_details, correct_id
+
+    def populate_yti_details(self):
+        """This method takes a property map like and updates the associated YoutrackIssue__c object accordingly
+           Format:
+           {"YoutrackIssue":{"property_name":"property_value"}}"""
+        from simple_salesforce import SalesforceResourceNotFound
+        prepared_yti_details, correct_id = self.prepare_yti_details(self.request.get('YoutrackIssue'))
         try:
             existing_case = self.connection_object.YoutrackIssue__c.get_by_custom_id('YTReadableId__c',
                                                                                      correct_id)
@@ -150,6 +349,67 @@ class SalesforceRequestHandler(RequestHandlerBase):
         except SalesforceResourceNotFound:
             return self.connection_object.YoutrackIssue__c.create(prepared_yti_details)
 
+    def populate_yti_details_batch(self, batch):
+        """Upserts many populate_yti_details requests on YTReadableId__c through sObject Collections,
+        one call per collection_size records (200 at most).
+        Takes a list of (request_uuid, request_body), returns {request_uuid: (success, status)}, status being
+        the HTTP status of the call that carried the record (None without a response). A record rejected inside
+        a successful call is reported as (False, statusCode, message) of its first error instead.
+        Renames (requests with old_issue_id) cannot be matched by an upsert on the new id,
+        so they still go through populate_yti_details one by one"""
+        results = {}
+        chunks = []
+        collection_size = min(int(self.config.get('collection size', 200)), 200)
+        for request_uuid, request_body in batch:
+            yti_details = request_body.get('YoutrackIssue')
+            if 'old_issue_id' in yti_details:
+                retry_policy.reset_status()
+                try:
+                    results[request_uuid] = (bool(self.for_request(request_body, request_uuid).populate_yti_details()),
+                                             retry_policy.last_status.get())
+                except Exception as e:
+                    if self.is_auth_error(e):
+                        raise
+                    kh_logging.for_request(logger, request_uuid, 'Salesforce', 'populate_yti_details').error(
+                        'Failed to update renamed YoutrackIssue__c: %r', e)
+                    results[request_uuid] = (False, retry_policy.exception_status(e) or retry_policy.last_status.get())
+                continue
+            prepared_yti_details, correct_id = self.prepare_yti_details(yti_details)
+            prepared_yti_details['attributes'] = {'type': 'YoutrackIssue__c'}
+            # The same external id may appear only once per collection
+            for chunk in chunks:
+                if len(chunk) < collection_size and correct_id not in chunk:
+                    chunk[correct_id] = (request_uuid, prepared_yti_details)
+                    break
+            else:
+                chunks.append({correct_id: (request_uuid, prepared_yti_details)})
+        for chunk in chunks:
+            records = list(chunk.values())
+            retry_policy.reset_status()
+            try:
+                outcomes = self.connection_object.restful('composite/sobjects/YoutrackIssue__c/YTReadableId__c',
+                                                          method='PATCH',
+                                                          json={'allOrNone': False,
+                                                                'records': [record for _, record in records]})
+            except Exception as e:
+                if self.is_auth_error(e):
+                    raise
+                logger.error('sObject Collections upsert of %s YoutrackIssue__c records failed: %r', len(records), e,
+                             extra={'destination': 'Salesforce', 'function': 'populate_yti_details'})
+                retry_policy.record_status(retry_policy.exception_status(e) or retry_policy.last_status.get())
+                outcomes = [{'success': False}] * len(records)
+            status = retry_policy.last_status.get()
+            for (request_uuid, _), outcome in zip(records, outcomes):
+                results[request_uuid] = (bool(outcome.get('success')), status)
+                if not outcome.get('success'):
+                    kh_logging.for_request(logger, request_uuid, 'Salesforce', 'populate_yti_details').error(
+                        'YoutrackIssue__c upsert failed: %s', outcome.get('errors'))
+                    errors = outcome.get('errors') or []
+                    if errors and errors[0].get('statusCode'):
+                        results[request_uuid] = (False, errors[0]['statusCode'],
+                                                 f"{errors[0]['statusCode']}: {errors[0].get('message')}"[:1000])
+        return results
+
 
 class KharonDatabaseHandler:
     def __init__(self):
@@ -157,48 +417,32 @@ class KharonDatabaseHandler:
 
     @staticmethod
     def load_config():
-        config = configparser.ConfigParser()
-        config.read('kh.ini')
-        return {key: config['Database information'][key] for key in config['Database information']}
+        return kh_config.load_section('Database information')
 
     def log_yt_comment(self, request_uuid, request_body):
-        con = sqlite3.connect(self.db_cfg['database_path'])
+        con = kh_db.get_connection(self.db_cfg['database_path'])
         cur = con.cursor()
         req_body = {x: request_body[x] for x in request_body if x not in {'From', 'To', 'Function'}}
         columns = ', '.join(req_body.keys())
         placeholders = ':' + ', :'.join(req_body.keys())
         query = 'INSERT INTO yt_comments (%s) VALUES (%s)' % (columns, placeholders)
-        # dbg(f'{request_uuid}|Constructed query: {query}')
         cur.execute(query, req_body)
-        dbg(f'{request_uuid}|Youtrack comment {req_body["created_comment_id"]} logged to database')
+        kh_logging.for_request(logger, request_uuid, 'YouTrack').info('Youtrack comment %s logged to database',
+                                                                     req_body['created_comment_id'])
         con.commit()
-        con.close()
 
     def mark_comment_as_deleted(self, comment_number):
-        con = sqlite3.connect(self.db_cfg['database_path'])
+        con = kh_db.get_connection(self.db_cfg['database_path'])
         cur = con.cursor()
         cur.execute(f'UPDATE yt_comments SET status = 2 WHERE number = ?', (comment_number,))
         con.commit()
-        con.close()
 
     def find_latest_comment(self, trigger_object_id, trigger_yt_id):
-        db_s = '''
-                CREATE TABLE yt_comments(
-                    [trigger_object] NVARCHAR(40) NOT NULL,
-                    [request_uuid] VARCHAR(40) NOT NULL,
-                    [engineer_comment] NVARCHAR(6000) NOT NULL,
-                    [created_datetime] TEXT,
-                    [created_comment_id] VARCHAR(40),
-                    [number] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-                    [created_comment_path] NVARCHAR(60) NOT NULL 
-                );
-                '''
-        con = sqlite3.connect(self.db_cfg['database_path'])
+        con = kh_db.get_connection(self.db_cfg['database_path'])
         cur = con.cursor()
         cur.execute(f'SELECT created_comment_path, number FROM yt_comments WHERE trigger_object = ? AND status = 1 '
                     f'ORDER BY created_datetime DESC LIMIT 1', (trigger_object_id,))
         located_comments = cur.fetchall()
-        con.close()
         return located_comments
 
 
@@ -213,39 +457,80 @@ class YoutrackRequestHandler(RequestHandlerBase):
         }
         self.required_details = {it.strip() for it in self.config['required details'].split(',')}
         self.api_endpoint = self.config['api endpoint']
+        self.kh_database = KharonDatabaseHandler()
+        # Parsed issue details shared by every request of this handler, see IssueDetailsCache
+        self.issue_cache = IssueDetailsCache('YouTrack', ttl=float(self.config.get('issue cache ttl', 60)),
+                                             max_size=int(self.config.get('issue cache size', 1000)))
         self.function_association = {
             'obtain_yti_details': self.obtain_yti_details,
             'mention_case_in_yti': self.mention_case_in_yti,
             'delete_kh_yt_comment': self.delete_kh_yt_comment
         }
+        self.async_function_association = {
+            'obtain_yti_details': self.obtain_yti_details_async,
+            'mention_case_in_yti': self.mention_case_in_yti_async,
+            'delete_kh_yt_comment': self.delete_kh_yt_comment_async
+        }
 
-    def obtain_yti_details(self):
+    def yti_details_url(self):
         issue_api_location = self.api_endpoint + '/issues/' + self.request['YTReadableId']
-        issue_with_fields = issue_api_location + '?fields=id,summary,' \
-                                                 'customFields(id,' \
-                                                 'projectCustomField(id,field(id,name)),value(name)),tags(id,name)'
-        request_yti_details = requests.get(issue_with_fields, headers=self.headers)
-        # print(request_yti_details.json())
+        return issue_api_location + '?fields=id,summary,' \
+                                    'customFields(id,' \
+                                    'projectCustomField(id,field(id,name)),value(name)),tags(id,name)'
+
+    def obtain_yti_details(self):
+        yti_details = self.issue_cache.get(self.request['YTReadableId'], self.load_yti_details)
+        return self.yti_details_message(yti_details)
+
+    async def obtain_yti_details_async(self):
+        yti_details = await self.issue_cache.get_async(self.request['YTReadableId'], self.load_yti_details_async)
+        return self.yti_details_message(yti_details)
+
+    def load_yti_details(self, stale):
+        issue_with_fields = self.yti_details_url()
+        request_yti_details = self.http.get(issue_with_fields, headers=self.conditional_headers(stale))
+        return self.parse_yti_details(issue_with_fields, request_yti_details)
+
+    async def load_yti_details_async(self, stale):
+        issue_with_fields = self.yti_details_url()
+        request_yti_details = await self.async_http().request('GET', issue_with_fields,
+                                                              headers=self.conditional_headers(stale))
+        return self.parse_yti_details(issue_with_fields, request_yti_details)
+
+    def conditional_headers(self, stale):
+        """Revalidates an expired cache entry with the validators YouTrack sent for it, if any"""
+        headers = dict(self.headers)
+        if stale is not None and stale.etag:
+            headers['If-None-Match'] = stale.etag
+        if stale is not None and stale.last_modified:
+            headers['If-Modified-Since'] = stale.last_modified
+        return headers
+
+    def yti_details_message(self, yti_details):
+        if yti_details is None:
+            return None
+        yti_main = {
+            "From": "YouTrack",
+            "To": self.request.get('From'),
+            "Function": "populate_yti_details",
+            "YoutrackIssue": dict(yti_details)}
+        return yti_main
+
+    def parse_yti_details(self, issue_with_fields, request_yti_details):
+        """Turns an issue details response into a cache entry (None if the lookup failed)"""
+        if request_yti_details.status_code == 304:
+            return NOT_MODIFIED
         if request_yti_details.status_code != 200:
             if request_yti_details.status_code == 404:
                 yti_details = {
                     'YTReadableId': self.request['YTReadableId'],
                     'State': 'Non-existent'
                 }
-                yti_main = {
-                    'From': 'YouTrack',
-                    'To': self.request.get('From'),
-                    'Function': 'populate_yti_details',
-                    'YoutrackIssue': yti_details
-                }
-                return json.dumps(yti_main)
+                return CacheEntry(yti_details)
             else:
-                with open('debug.txt', 'a+') as log:
-                    log.write(f'{self.requestId}|ERROR|'
-                              f'Failed to obtain details for issue {self.request["YTReadableId"]}\n'
-                              f'API URL used: {issue_with_fields}\n'
-                              f'Status code: {request_yti_details.status_code}'
-                              f'Server response: {request_yti_details.text}')
+                self.log.error('Failed to obtain details for issue %s\nAPI URL used: %s\nStatus code: %s\n'
+                               'Server response: %s', self.request['YTReadableId'], issue_with_fields,
+                               request_yti_details.status_code, request_yti_details.text)
                 return None
 
         else:
@@ -264,18 +549,12 @@ class YoutrackRequestHandler(RequestHandlerBase):
                         value = cf['value']['name']
                         yti_details[name.replace(' ', '_')] = value
                 except IndexError:
-                    with open('debug.txt', 'a+') as log:
-                        log.write(f'Unexpected json structure:\n'
-                                  f'{str(cf)}')
+                    self.log.warning('Unexpected json structure:\n%s', cf)
             for tag in json_response['tags']:
                 if tag['name'] in self.required_details:
                     yti_details[tag['name'].replace(' ', '_')] = True
-            yti_main = {
-                "From": "YouTrack",
-                "To": self.request.get('From'),
-                "Function": "populate_yti_details",
-                "YoutrackIssue": yti_details}
-            return json.dumps(yti_main)
+            return CacheEntry(yti_details, request_yti_details.headers.get('ETag'),
+                              request_yti_details.headers.get('Last-Modified'))
 
     def mention_case_in_yti(self):
         """Creates an automated comment in the YT Issue referenced in the JSON request provided and logs
@@ -295,6 +574,20 @@ class YoutrackRequestHandler(RequestHandlerBase):
             }
         }
         """
+        issue_comments_api_location, comment_text = self.build_case_comment()
+        post_comment_request = self.http.post(issue_comments_api_location, data=json.dumps(comment_text),
+                                              headers=self.headers)
+        return self.log_case_comment(issue_comments_api_location, comment_text, post_comment_request)
+
+    async def mention_case_in_yti_async(self):
+        issue_comments_api_location, comment_text = self.build_case_comment()
+        post_comment_request = await self.async_http().request('POST', issue_comments_api_location,
+                                                              content=json.dumps(comment_text),
+                                                              headers=self.headers)
+        return await asyncio.to_thread(self.log_case_comment, issue_comments_api_location, comment_text,
+                                       post_comment_request)
+
+    def build_case_comment(self):
         issue_comments_api_location = self.api_endpoint + '/issues/' + self.request['YTReadableId'] + '/comments'
         case_information = self.request.get('CaseInformation')
         customer_information = case_information.get('CustomerInformation')
@@ -313,23 +606,15 @@ class YoutrackRequestHandler(RequestHandlerBase):
                 if not case_information.get("CommentFromEngineer").isspace():
                     comment_text['text'] += f'Engineer comment: {case_information.get("CommentFromEngineer")}\n'
         comment_text['text'] += 'This comment was generated automatically by kh'
-        json_comment = json.dumps(comment_text)
-        post_comment_request = requests.post(issue_comments_api_location, data=json_comment, headers=self.headers)
-        # print(post_comment_request.text)
+        return issue_comments_api_location, comment_text
+
+    def log_case_comment(self, issue_comments_api_location, comment_text, post_comment_request):
+        if not 200 <= post_comment_request.status_code < 300:
+            # The status recorded by http_session decides whether the request is retried
+            self.log.error('Failed to comment on issue %s\nStatus code: %s\nServer response: %s',
+                           self.request['YTReadableId'], post_comment_request.status_code, post_comment_request.text)
+            return False
         response = post_comment_request.json()
-        db_s = '''
-        CREATE TABLE yt_comments(
-            [trigger_object] NVARCHAR(40) NOT NULL,
-            [request_uuid] VARCHAR(40) NOT NULL,
-            [engineer_comment] NVARCHAR(6000) NOT NULL,
-            [created_datetime] TEXT,
-            [created_comment_id] VARCHAR(40),
-            [number] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-            [created_comment_path] NVARCHAR(60) NOT NULL,
-            [trigger_yt_id] NVARCHAR(50),
-            [status] INTEGER DEFAULT 0
-        );
-        '''
         comment_for_db = {
             'trigger_object': self.request['TriggerObject'],
             'request_uuid': self.requestId,
@@ -343,8 +628,7 @@ class YoutrackRequestHandler(RequestHandlerBase):
             'To': 'db',
             'Function': 'log_yti_comment'
         }
-        kh_db = KharonDatabaseHandler()
-        kh_db.log_yt_comment(self.requestId, comment_for_db)
+        self.kh_database.log_yt_comment(self.requestId, comment_for_db)
         return True
 
     def delete_kh_yt_comment(self):
@@ -359,24 +643,37 @@ class YoutrackRequestHandler(RequestHandlerBase):
             'Function': delete_kh_yt_comment
         }
         """
-        # issue_comments_api_location = self.api_endpoint + '/issues/' + self.request['YTReadableId'] + '/comments'
-        kh_db = KharonDatabaseHandler()
-        relevant_comment = kh_db.find_latest_comment(self.request['TriggerObject'], self.request['YTReadableId'])
-
-        if relevant_comment:
-            print(relevant_comment)
-            delete_request = requests.post(
-                relevant_comment[0][0], data=json.dumps({'deleted': True}), headers=self.headers)
-            if delete_request.status_code != 200:
-                dbg(f"{self.requestId}|ERROR|Failed to delete comment {relevant_comment[0][1]}"
-                    f" ({relevant_comment[0][0]})\n")
-                dbg(f"{self.requestId}|INFO|YT Response: {delete_request.text}\n")
-                return False
-            dbg(f"{self.requestId}|"
-                f"INFO|Successfully deleted comment {relevant_comment[0][1]}({relevant_comment[0][0]})\n")
-            kh_db.mark_comment_as_deleted(relevant_comment[0][1])
+        relevant_comment = self.find_comment_to_delete()
+        if not relevant_comment:
             return True
-        else:
-            dbg(f"{self.requestId}|INFO|No comment found for trigger_object {self.request['TriggerObject']} "
-                f"and Youtrack Issue {self.request['YTReadableId']}\n")
+        delete_request = self.http.post(
+            relevant_comment[0][0], data=json.dumps({'deleted': True}), headers=self.headers)
+        return self.handle_comment_deletion(relevant_comment, delete_request)
+
+    async def delete_kh_yt_comment_async(self):
+        # kh.db is only reached through blocking sqlite3 calls, which must not hold up the event loop
+        relevant_comment = await asyncio.to_thread(self.find_comment_to_delete)
+        if not relevant_comment:
+            return True
+        delete_request = await self.async_http().request('POST', relevant_comment[0][0],
+                                                        content=json.dumps({'deleted': True}),
+                                                        headers=self.headers)
+        return await asyncio.to_thread(self.handle_comment_deletion, relevant_comment, delete_request)
+
+    def find_comment_to_delete(self):
+        # issue_comments_api_location = self.api_endpoint + '/issues/' + self.request['YTReadableId'] + '/comments'
+        relevant_comment = self.kh_database.find_latest_comment(self.request['TriggerObject'],
+                                                                self.request['YTReadableId'])
+        if not relevant_comment:
+            self.log.info('No comment found for trigger_object %s and Youtrack Issue %s',
+                          self.request['TriggerObject'], self.request['YTReadableId'])
+        return relevant_comment
+
+    def handle_comment_deletion(self, relevant_comment, delete_request):
+        if delete_request.status_code != 200:
+            self.log.error('Failed to delete comment %s (%s)\nYT Response: %s',
+                           relevant_comment[0][1], relevant_comment[0][0], delete_request.text)
+            return False
+        self.log.info('Successfully deleted comment %s (%s)', relevant_comment[0][1], relevant_comment[0][0])
+        self.kh_database.mark_comment_as_deleted(relevant_comment[0][1])
         return True
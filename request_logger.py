@@ -1,36 +1,83 @@
 from flask import Flask, request
 from uuid import uuid4
-import sqlite3
 import datetime
+import glob
 import json
+import kh_config
+import kh_metrics
+import priorities
+import request_schemas
+import threading
+import time
+import kh_db
+import wakeup
+from ingest_buffer import GroupCommitWriter
 
 app = Flask(__name__)
-dbSchema = '''
-CREATE TABLE IF NOT EXISTS "kharon_requests"
-(
-    [Id] INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-    [requestUUID] VARCHAR(40)  NOT NULL,
-    [failedToExecute] INTEGER DEFAULT 0,
-    [requestedFunction] VARCHAR(40) NOT NULL,
-[requestBody] NVARCHAR(6000),
-[requestFrom] VARCHAR(40),
-[requestTo] VARCHAR(40),
-[referenceObjectId] VARCHAR(40),
-[createdDatetime] TEXT,
-[headers] TEXT,
-[Completed] INTEGER DEFAULT 0, 
-TriggerObject NVARCHAR(60));
-'''
+default_database_path = '/etc/kharon_db/kharon.db'
+request_columns = ['requestUUID', 'requestBody', 'headers', 'requestedFunction', 'requestFrom', 'requestTo',
+                   'createdDatetime', 'TriggerObject', 'priority']
+insert_query = 'INSERT INTO kharon_requests (%s) VALUES (%s)' % (', '.join(request_columns),
+                                                                 ':' + ', :'.join(request_columns))
+group_commit_writer = None
+group_commit_lock = threading.Lock()
+connection_pools = {}
+ingested_total = kh_metrics.counter('kharon_ingested_requests_total', 'Requests accepted by /api and /api/bulk')
+ingestion_seconds = kh_metrics.histogram('kharon_ingestion_seconds', 'Time to durably queue an /api request')
 
 
-def store_in_database(requestUUID, requestToLog):
-    requestJSON = requestToLog.get_json()
-    requestHeaders = requestToLog.headers
-    trigger_object = requestJSON.get('TriggerObject')
-    conn = sqlite3.connect('/etc/kharon_db/kharon.db')
-    cur = conn.cursor()
+def database_path():
+    config = kh_config.load_config()
+    if config.has_section('Database information'):
+        return config['Database information'].get('database_path', default_database_path)
+    return default_database_path
+
+
+def metrics_file():
+    config = kh_config.load_config()
+    return config['Metrics'].get('metrics file') if config.has_section('Metrics') else None
+
+
+def wakeup_socket():
+    config = kh_config.load_config()
+    return config['Dispatcher'].get('wakeup socket') if config.has_section('Dispatcher') else None
+
+
+def ingestion_config():
+    config = kh_config.load_config()
+    return {key: config['Ingestion'][key] for key in config['Ingestion']} if config.has_section('Ingestion') else {}
+
+
+def group_commit_enabled():
+    return ingestion_config().get('group commit', 'no').lower() in {'yes', 'true', '1'}
+
+
+def connection_pool():
+    """The connections /api and /api/bulk insert with, sized by 'connections' in the [Ingestion] section"""
+    path = database_path()
+    with group_commit_lock:
+        if path not in connection_pools:
+            connection_pools[path] = kh_db.ConnectionPool(path, int(ingestion_config().get('connections', 4)))
+        return connection_pools[path]
+
+
+def get_group_commit_writer():
+    """Returns the process-wide group commit writer, configured by 'group size' and 'group delay ms' in the
+    [Ingestion] section of kh.ini"""
+    global group_commit_writer
+    with group_commit_lock:
+        if group_commit_writer is None or not group_commit_writer.thread.is_alive():
+            cfg = ingestion_config()
+            group_commit_writer = GroupCommitWriter(database_path(), insert_query,
+                                                    max_rows=int(cfg.get('group size', 200)),
+                                                    max_delay=float(cfg.get('group delay ms', 10)) / 1000,
+                                                    on_flush=lambda: wakeup.notify(wakeup_socket()))
+        return group_commit_writer
+
+
+def build_request_row(requestUUID, requestJSON, requestHeaders):
     moment = datetime.datetime.now().astimezone().replace(microsecond=0).isoformat()
-    req = {
+    return {
         'requestUUID': requestUUID,
         'requestBody': json.dumps(requestJSON),
         'headers': str(requestHeaders),
@@ -38,26 +85,96 @@ def store_in_database(requestUUID, requestToLog):
         'requestFrom': requestJSON['From'],
         'requestTo': requestJSON['To'],
         'createdDatetime': str(moment),
-        'TriggerObject': trigger_object
+        'TriggerObject': requestJSON.get('TriggerObject'),
+        'priority': priorities.priority_for(requestJSON)
     }
-    columns = ', '.join(req.keys())
-    placeholders = ':' + ', :'.join(req.keys())
-    query = 'INSERT INTO kharon_requests (%s) VALUES (%s)' % (columns, placeholders)
-    cur.execute(query, req)
-    conn.commit()
-    conn.close()
+
+
+def store_in_database(requestUUID, requestToLog):
+    req = build_request_row(requestUUID, requestToLog.get_json(), requestToLog.headers)
+    with connection_pool().connection() as conn:
+        with conn:
+            conn.execute(insert_query, req)
+    wakeup.notify(wakeup_socket())
     return True
 
 
+def store_group_committed(rows):
+    try:
+        return get_group_commit_writer().submit(rows)
+    except Exception:
+        return False
+
+
 @app.route('/api', methods=['POST', 'GET'])
 def handle_request():
     if request.method == 'POST':
         if request.is_json:
+            started = time.monotonic()
             request_uuid = uuid4()
-            success = store_in_database(str(request_uuid), request)
+            errors = request_schemas.validate(request.get_json(silent=True))
+            if errors:
+                return json.dumps({'RequestNotCreated': errors}), 400
+            if group_commit_enabled():
+                request_json = request.get_json()
+                success = store_group_committed([build_request_row(str(request_uuid), request_json,
+                                                                   request.headers)])
+            else:
+                success = store_in_database(str(request_uuid), request)
+            ingestion_seconds.observe(time.monotonic() - started, endpoint='/api')
             if success:
+                ingested_total.inc(endpoint='/api')
                 return json.dumps({'RequestCreated': str(request_uuid)}), 200
             else:
                 return json.dumps({'RequestNotCreated': str(-1)}), 502
     return
 
+
+@app.route('/api/bulk', methods=['POST'])
+def handle_bulk_request():
+    """Accepts a JSON array of requests; either all of them are queued (in one transaction) or none"""
+    request_json = request.get_json(silent=True)
+    if not isinstance(request_json, list) or not request_json:
+        return json.dumps({'RequestsNotCreated': 'A non-empty JSON array is required'}), 400
+    errors = {index: request_schemas.validate(it) for index, it in enumerate(request_json)}
+    invalid = [index for index, it_errors in errors.items() if it_errors]
+    if invalid:
+        return json.dumps({'RequestsNotCreated': 'Invalid requests', 'Invalid': invalid,
+                           'Errors': {str(index): errors[index] for index in invalid}}), 400
+    started = time.monotonic()
+    request_uuids = [str(uuid4()) for _ in request_json]
+    rows = [build_request_row(request_uuid, it, request.headers)
+            for request_uuid, it in zip(request_uuids, request_json)]
+    if group_commit_enabled():
+        success = store_group_committed(rows)
+    else:
+        with connection_pool().connection() as conn:
+            with conn:
+                conn.executemany(insert_query, rows)
+        wakeup.notify(wakeup_socket())
+        success = True
+    ingestion_seconds.observe(time.monotonic() - started, endpoint='/api/bulk')
+    if success:
+        ingested_total.inc(len(request_uuids), endpoint='/api/bulk')
+        return json.dumps({'RequestsCreated': request_uuids}), 200
+    return json.dumps({'RequestsNotCreated': str(-1)}), 502
+
+
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    """Prometheus exposition of the ingestion metrics merged with the dispatcher's, which main.py writes
+    to [Metrics] 'metrics file' ('<metrics file>.<n>' with a worker="<n>" label under supervisor.py)"""
+    expositions = [(kh_metrics.registry.render(), {})]
+    path = metrics_file()
+    if path:
+        worker_paths = [(worker_path, {'worker': worker_path.rsplit('.', 1)[1]})
+                        for worker_path in sorted(glob.glob(glob.escape(path) + '.*'))
+                        if worker_path.rsplit('.', 1)[1].isdigit()]
+        for dispatcher_path, labels in [(path, {})] + worker_paths:
+            try:
+                with open(dispatcher_path, encoding='utf-8') as dispatcher_metrics:
+                    expositions.append((dispatcher_metrics.read(), labels))
+            except OSError:
+                pass
+    exposition = kh_metrics.merge_expositions(expositions)
+    return exposition, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
@@ -0,0 +1,242 @@
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+import kh_db
+import kh_logging
+import priorities
+from request_envelope import RequestEnvelope
+
+logger = kh_logging.get_logger('queue')
+
+# Completed: 0 pending, 1 done, 2 dead-lettered (see kharon_dead_letters)
+# A row also waits for every older unfinished row of its TriggerObject, whether that one is leased by another
+# worker, waiting for its retry or not claimed yet, so the requests of an object run in createdDatetime order
+# even with several dispatchers sharing the database
+pending_condition = ('Completed = 0 AND (nextAttemptAt IS NULL OR nextAttemptAt <= :now) '
+                     'AND (leaseExpiresAt IS NULL OR leaseExpiresAt < :now) '
+                     'AND NOT EXISTS (SELECT 1 FROM kharon_requests o '
+                     'WHERE o.TriggerObject = kharon_requests.TriggerObject AND o.Completed = 0 '
+                     'AND o.createdDatetime < kharon_requests.createdDatetime)')
+
+claim_columns = ('Id, requestUUID, requestTo, requestedFunction, TriggerObject, requestBody, stageBody, '
+                 'failedToExecute, createdDatetime, priority')
+
+# Workers started by supervisor.py each claim the requests of one partition; requests sharing a TriggerObject
+# always land in the same one, so their order is kept
+partition_condition = ' AND kh_partition(COALESCE(TriggerObject, requestUUID), :partition_count) = :partition_index'
+
+
+def claim_queries(partitioned=False):
+    """Returns the query for the share of one priority (oldest first) and the query filling what the
+    priorities did not use of their shares (most urgent first)"""
+    condition = pending_condition + (partition_condition if partitioned else '')
+    priority_query = f'''
+    SELECT {claim_columns} FROM kharon_requests
+    WHERE {condition} AND priority = :priority ORDER BY createdDatetime LIMIT :limit
+    '''
+    fill_query = f'''
+    SELECT {claim_columns} FROM kharon_requests
+    WHERE {condition} ORDER BY priority, createdDatetime LIMIT :limit
+    '''
+    return priority_query, fill_query
+
+
+depth_query = 'SELECT priority, COUNT(*) FROM kharon_requests WHERE Completed = 0 GROUP BY priority'
+
+
+complete_query = 'UPDATE kharon_requests SET Completed = 1 WHERE requestUUID = ?'
+fail_query = 'UPDATE kharon_requests SET failedToExecute = ?, nextAttemptAt = ?, lastError = ? WHERE requestUUID = ?'
+dead_letter_query = 'UPDATE kharon_requests SET Completed = 2, failedToExecute = ?, nextAttemptAt = NULL, ' \
+                    'lastError = ? WHERE requestUUID = ?'
+release_query = 'UPDATE kharon_requests SET workerId = NULL, leaseExpiresAt = NULL WHERE workerId = ?'
+postpone_query = 'UPDATE kharon_requests SET nextAttemptAt = ? WHERE requestUUID = ?'
+supersede_query = 'UPDATE kharon_requests SET Completed = 1, supersededBy = ? WHERE requestUUID = ?'
+checkpoint_query = 'UPDATE kharon_requests SET stageBody = ?, stage = stage + 1 WHERE requestUUID = ?'
+child_insert_query = '''
+INSERT INTO kharon_requests (requestUUID, requestBody, requestedFunction, requestFrom, requestTo, createdDatetime,
+                             TriggerObject, parentUUID, priority)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+heartbeat_query = 'UPDATE kharon_requests SET leaseExpiresAt = ? WHERE workerId = ? AND Completed = 0'
+
+
+def dispatch_order(rows):
+    """Orders claimed rows most urgent first, oldest first within a priority. A row is moved up to the priority
+    of the most urgent later row with the same TriggerObject, so those still run in createdDatetime order"""
+    rows = sorted(rows, key=lambda row: row[8] or '')
+    chain_priority = {}
+    effective_priority = {}
+    for row in reversed(rows):
+        key = row[4] or row[1]
+        priority = row[9] if row[9] is not None else priorities.DEFAULT_PRIORITY
+        chain_priority[key] = min(priority, chain_priority.get(key, priority))
+        effective_priority[row[0]] = chain_priority[key]
+    return sorted(rows, key=lambda row: effective_priority[row[0]])
+
+
+def new_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+
+
+class StatusBatch:
+    """Collects the outcome of the requests of a batch, so that all of them are committed in one transaction.
+    Safe to use from several worker threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.updates = {}
+
+    def _add(self, query, parameters):
+        with self.lock:
+            self.updates.setdefault(query, []).append(parameters)
+
+    def complete(self, request_uuid):
+        self._add(complete_query, (request_uuid,))
+
+    def fail(self, request_uuid, failed_to_execute, next_attempt_at=None, error=None):
+        """Schedules another attempt of the request, not before next_attempt_at (Unix time)"""
+        self._add(fail_query, (failed_to_execute, next_attempt_at, error, request_uuid))
+
+    def postpone(self, request_uuid, not_before):
+        """Puts the request back into the queue until not_before (Unix time), without counting an attempt"""
+        self._add(postpone_query, (not_before, request_uuid))
+
+    def supersede(self, request_uuid, by_uuid):
+        """Completes a request without executing it, because by_uuid made it redundant"""
+        self._add(supersede_query, (by_uuid, request_uuid))
+
+    def checkpoint(self, request_uuid, stage_body):
+        """Records the next stage of the request, which is where its retries resume"""
+        self._add(checkpoint_query, (json.dumps(stage_body), request_uuid))
+
+    def fan_out(self, request_uuid, stage_bodies, trigger_object=None):
+        """Queues every stage as a child row of the request, returns the UUIDs of the children"""
+        moment = str(datetime.datetime.now().astimezone().replace(microsecond=0).isoformat())
+        child_uuids = []
+        for stage_body in stage_bodies:
+            child_uuids.append(str(uuid4()))
+            self._add(child_insert_query, (child_uuids[-1], json.dumps(stage_body), stage_body['Function'],
+                                           stage_body['From'], stage_body['To'], moment,
+                                           stage_body.get('TriggerObject') or trigger_object, request_uuid,
+                                           priorities.priority_for(stage_body)))
+        return child_uuids
+
+    def dead_letter(self, request_uuid, failed_to_execute, error_class, error=None):
+        """Takes the request out of the queue and records it in kharon_dead_letters"""
+        with self.lock:
+            self.updates.setdefault(dead_letter_query, []).append((failed_to_execute, error, request_uuid))
+            self.updates.setdefault(kh_db.dead_letter_insert_query, []).append((error_class, time.time(),
+                                                                                request_uuid))
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(parameters) for parameters in self.updates.values())
+
+    def write(self, con):
+        """Executes the collected updates on con (without committing). They stay in the batch until clear(),
+        so a transaction that fails to commit can be written again"""
+        with self.lock:
+            updates = {query: list(parameters) for query, parameters in self.updates.items()}
+        for query, parameters in updates.items():
+            con.executemany(query, parameters)
+
+    def clear(self):
+        with self.lock:
+            self.updates = {}
+
+
+class RequestQueue:
+    """Lease-based claim of kharon_requests rows, so several dispatcher processes can share one database.
+    A claim atomically stamps a batch with this worker's id and a lease expiry; a heartbeat thread keeps
+    extending the lease while the batch is being worked on, and rows of a dead worker become claimable
+    again once their lease expires.
+    Every priority gets its weighted share of a batch (see priorities.shares), the rest of the batch is
+    filled with the most urgent remaining rows"""
+
+    def __init__(self, database_path, worker_id=None, lease_seconds=60, batch_size=100, weights=None,
+                 partition=None):
+        self.database_path = database_path
+        self.worker_id = worker_id or new_worker_id()
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.shares = priorities.shares(batch_size, weights or priorities.parse_weights(None))
+        # (index, count): only claim requests whose TriggerObject hashes to index, see kh_db.partition_of
+        self.partition = partition
+        self.claim_priority_query, self.claim_fill_query = claim_queries(partition is not None)
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread = None
+
+    def connect(self):
+        return kh_db.get_connection(self.database_path)
+
+    def claim(self):
+        """Leases up to batch_size pending rows, returns them as RequestEnvelopes in dispatch_order.
+        For a request checkpointed past its first stage, the envelope carries the stage to resume"""
+        now = time.time()
+        lease_expires_at = now + self.lease_seconds
+        parameters = {'now': now}
+        if self.partition is not None:
+            parameters.update(partition_index=self.partition[0], partition_count=self.partition[1])
+        con = self.connect()
+        with kh_db.immediate_transaction(con):
+            selected = {}
+            for priority, share in self.shares:
+                for row in con.execute(self.claim_priority_query, dict(parameters, priority=priority, limit=share)):
+                    selected[row[0]] = row
+            if len(selected) < self.batch_size:
+                for row in con.execute(self.claim_fill_query, dict(parameters, limit=self.batch_size)):
+                    if len(selected) >= self.batch_size:
+                        break
+                    selected.setdefault(row[0], row)
+            con.executemany('UPDATE kharon_requests SET workerId = ?, leaseExpiresAt = ? WHERE Id = ?',
+                            [(self.worker_id, lease_expires_at, row_id) for row_id in selected])
+        return [RequestEnvelope.from_row(row[1:9]) for row in dispatch_order(selected.values())]
+
+    def depth(self):
+        """Returns {priority: number of unfinished requests}"""
+        return dict(self.connect().execute(depth_query).fetchall())
+
+    def heartbeat(self):
+        con = self.connect()
+        with con:
+            con.execute(heartbeat_query, (time.time() + self.lease_seconds, self.worker_id))
+
+    def release(self):
+        """Gives up the leases of the current batch, so failed rows can be claimed again by any worker"""
+        con = self.connect()
+        with con:
+            con.execute(release_query, (self.worker_id,))
+
+    def finish(self, status_batch):
+        """Commits the outcome of the batch and releases its leases in a single transaction.
+        status_batch is only emptied once the transaction is committed"""
+        con = self.connect()
+        with con:
+            status_batch.write(con)
+            con.execute(release_query, (self.worker_id,))
+        status_batch.clear()
+
+    def _heartbeat_loop(self):
+        while not self.heartbeat_stop.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e:
+                logger.warning('Lease heartbeat of worker %s failed: %r', self.worker_id, e)
+
+    def start_heartbeat(self):
+        if self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='kh-lease-heartbeat',
+                                                     daemon=True)
+            self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self.heartbeat_stop.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        self.heartbeat_stop.clear()
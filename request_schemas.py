@@ -0,0 +1,89 @@
+"""Payload schemas of the functions kharon can execute, checked by /api before a request is queued and by the
+dispatcher before a handler is called (handlers produce further stages, and older rows predate the checks).
+
+A schema maps a field (dotted paths reach into nested objects) to the check its value has to pass.
+Schemas are compiled once into flat lists of checks, so validating a request costs a dict lookup and a
+few isinstance calls."""
+
+IDENTITY_FIELDS = ('From', 'To', 'Function')
+
+
+def text(value):
+    return None if isinstance(value, str) and value.strip() else 'a non-empty string is required'
+
+
+def mapping(value):
+    return None if isinstance(value, dict) else 'an object is required'
+
+
+def one_of(*choices):
+    def check(value):
+        return None if value in choices else f'one of {", ".join(choices)} is required'
+    return check
+
+
+SCHEMAS = {
+    ('Slack', 'send_slack_notification'): {
+        'notification_destination_type': one_of('user', 'channel'),
+        'notification_destination': text,
+        'notification_text': text
+    },
+    ('YouTrack', 'obtain_yti_details'): {
+        'YTReadableId': text
+    },
+    ('YouTrack', 'mention_case_in_yti'): {
+        'YTReadableId': text,
+        'TriggerObject': text,
+        'CaseInformation': mapping,
+        'CaseInformation.CustomerInformation': mapping
+    },
+    ('YouTrack', 'delete_kh_yt_comment'): {
+        'YTReadableId': text,
+        'TriggerObject': text
+    },
+    ('Salesforce', 'populate_yti_details'): {
+        'YoutrackIssue': mapping,
+        'YoutrackIssue.YTReadableId': text
+    },
+    ('ProductBoard', 'create_pb_item'): {
+        'pbnote_data': mapping
+    }
+}
+
+
+class PayloadSchema:
+    __slots__ = ('checks',)
+
+    def __init__(self, fields):
+        self.checks = [(field, tuple(field.split('.')), check) for field, check in fields.items()]
+
+    def errors(self, request_body):
+        errors = []
+        for field, path, check in self.checks:
+            value = request_body
+            for part in path:
+                value = value.get(part) if isinstance(value, dict) else None
+            error = 'missing' if value is None else check(value)
+            if error:
+                errors.append(f'{field}: {error}')
+        return errors
+
+
+compiled_schemas = {key: PayloadSchema(fields) for key, fields in SCHEMAS.items()}
+destinations = {destination for destination, _ in SCHEMAS}
+
+
+def validate(request_body):
+    """Returns the problems of a request as a list of messages, empty if it can be queued"""
+    if not isinstance(request_body, dict):
+        return ['a JSON object is required']
+    errors = [f'{field}: missing' for field in IDENTITY_FIELDS if not request_body.get(field)]
+    if errors:
+        return errors
+    destination, function = request_body['To'], request_body['Function']
+    schema = compiled_schemas.get((destination, function))
+    if schema is None:
+        if destination not in destinations:
+            return [f'To: unknown destination {destination}']
+        return [f'Function: {destination} has no function {function}']
+    return schema.errors(request_body)
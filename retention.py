@@ -0,0 +1,186 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import time
+import kh_config
+import kh_db
+import kh_logging
+
+logger = kh_logging.get_logger('retention')
+
+# Completed = 1 (done) and 2 (dead-lettered) are finished, see request_queue.pending_condition
+finished_query = '''
+SELECT Id, substr(createdDatetime, 1, 7) FROM kharon_requests
+WHERE Completed IN (1, 2) AND julianday(createdDatetime) < julianday('now', ?)
+ORDER BY Id LIMIT ?
+'''
+
+archive_indexes = [
+    'CREATE INDEX IF NOT EXISTS idx_archive_requests_uuid ON kharon_requests (requestUUID)',
+    'CREATE INDEX IF NOT EXISTS idx_archive_requests_trigger ON kharon_requests (TriggerObject)',
+    'CREATE INDEX IF NOT EXISTS idx_archive_dead_letters_uuid ON kharon_dead_letters (requestUUID)'
+]
+
+
+def table_columns(con, table):
+    return [row[1] for row in con.execute(f'PRAGMA table_info({table})')]
+
+
+def archive_path(archive_dir, month):
+    return os.path.join(archive_dir, f'kharon-archive-{month or "undated"}.db')
+
+
+def open_archive(path, columns):
+    """Opens (creating if needed) a monthly archive file with the columns of the live tables"""
+    con = sqlite3.connect(path, timeout=30)
+    con.execute('PRAGMA journal_mode = WAL')
+    for table, table_schema in columns.items():
+        con.execute(f'CREATE TABLE IF NOT EXISTS {table} ([Id] INTEGER PRIMARY KEY)')
+        kh_db.add_missing_columns(con, table, {column: '' for column in table_schema if column != 'Id'})
+    for index in archive_indexes:
+        con.execute(index)
+    return con
+
+
+def copy_rows(source, target, table, columns, key, values):
+    placeholders = ', '.join('?' * len(values))
+    column_list = ', '.join(f'[{column}]' for column in columns)
+    rows = source.execute(f'SELECT {column_list} FROM {table} WHERE {key} IN ({placeholders})', values).fetchall()
+    target.executemany(f'INSERT OR IGNORE INTO {table} ({column_list}) VALUES ({", ".join("?" * len(columns))})',
+                       rows)
+    return len(rows)
+
+
+def archive_finished(database_path, archive_dir, days, batch_size=5000, max_rows=None):
+    """Moves finished requests created more than days ago (and their dead-letter records) into one SQLite
+    file per month under archive_dir. Rows are first committed to the archive and only then deleted from
+    kharon_requests, so an interrupted run leaves duplicates behind at worst, which the next run removes.
+    Returns the number of rows archived"""
+    os.makedirs(archive_dir, exist_ok=True)
+    con = kh_db.get_connection(database_path)
+    columns = {table: table_columns(con, table) for table in ('kharon_requests', 'kharon_dead_letters')}
+    archived = 0
+    while max_rows is None or archived < max_rows:
+        limit = batch_size if max_rows is None else min(batch_size, max_rows - archived)
+        finished = con.execute(finished_query, (f'-{float(days)} days', limit)).fetchall()
+        if not finished:
+            break
+        months = {}
+        for row_id, month in finished:
+            months.setdefault(month, []).append(row_id)
+        for month, row_ids in months.items():
+            request_uuids = [row[0] for row in con.execute(
+                'SELECT requestUUID FROM kharon_requests WHERE Id IN (%s)' % ', '.join('?' * len(row_ids)), row_ids)]
+            archive = open_archive(archive_path(archive_dir, month), columns)
+            try:
+                with archive:
+                    copy_rows(con, archive, 'kharon_requests', columns['kharon_requests'], 'Id', row_ids)
+                    copy_rows(con, archive, 'kharon_dead_letters', columns['kharon_dead_letters'], 'requestUUID',
+                              request_uuids)
+            finally:
+                archive.close()
+            with con:
+                con.execute('DELETE FROM kharon_dead_letters WHERE requestUUID IN (%s)'
+                            % ', '.join('?' * len(request_uuids)), request_uuids)
+                con.execute('DELETE FROM kharon_requests WHERE Id IN (%s)' % ', '.join('?' * len(row_ids)), row_ids)
+            archived += len(row_ids)
+        logger.info('Archived %s finished requests', archived)
+    return archived
+
+
+def incremental_vacuum(database_path, pages=None):
+    """Returns up to pages free pages (all of them by default) to the file system.
+    Databases created before auto_vacuum = INCREMENTAL was part of kh_db.connection_pragmas need one full
+    VACUUM (see full_vacuum) before this has any effect. Returns the number of free pages left"""
+    con = kh_db.get_connection(database_path)
+    if con.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        logger.warning('%s is not in incremental auto_vacuum mode, run "retention.py vacuum --full" once',
+                       database_path)
+        return con.execute('PRAGMA freelist_count').fetchone()[0]
+    con.execute(f'PRAGMA incremental_vacuum({int(pages)})' if pages else 'PRAGMA incremental_vacuum').fetchall()
+    return con.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def full_vacuum(database_path):
+    """Rebuilds the database file, switching it to incremental auto_vacuum. Needs exclusive access for as long
+    as the rebuild takes, so run it while the dispatcher and the Flask app are stopped"""
+    con = kh_db.get_connection(database_path)
+    con.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    con.execute('VACUUM')
+
+
+def run(config):
+    """One retention pass with the settings of the [Retention] section of kh.ini"""
+    database_path = config['Database information']['database_path']
+    retention_cfg = config['Retention'] if config.has_section('Retention') else {}
+    started = time.monotonic()
+    archived = archive_finished(database_path,
+                                retention_cfg.get('archive dir', os.path.join(os.path.dirname(database_path),
+                                                                              'archive')),
+                                float(retention_cfg.get('archive after days', 30)),
+                                batch_size=int(retention_cfg.get('batch size', 5000)),
+                                max_rows=int(retention_cfg['max rows per run'])
+                                if retention_cfg.get('max rows per run') else None)
+    free_pages = incremental_vacuum(database_path, int(retention_cfg.get('vacuum pages', 0)) or None)
+    logger.info('Retention pass archived %s requests in %.1fs, %s free pages left', archived,
+                time.monotonic() - started, free_pages)
+    return archived
+
+
+def lookup(database_path, archive_dir, request_uuid=None, trigger_object=None):
+    """Finds requests by requestUUID or TriggerObject in the live database and then in the archives
+    (newest month first). Returns a list of dicts, each with the file it was found in"""
+    column, value = ('requestUUID', request_uuid) if request_uuid else ('TriggerObject', trigger_object)
+    found = []
+    paths = [database_path] + sorted(glob.glob(os.path.join(archive_dir, 'kharon-archive-*.db')), reverse=True)
+    for path in paths:
+        con = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        con.row_factory = sqlite3.Row
+        try:
+            for row in con.execute(f'SELECT * FROM kharon_requests WHERE {column} = ? ORDER BY Id', (value,)):
+                request = dict(row)
+                dead_letter = con.execute('SELECT errorClass, lastError, deadLetteredAt FROM kharon_dead_letters '
+                                          'WHERE requestUUID = ?', (request['requestUUID'],)).fetchone()
+                request['deadLetter'] = dict(dead_letter) if dead_letter else None
+                request['foundIn'] = path
+                found.append(request)
+        except sqlite3.OperationalError as e:
+            logger.warning('Could not search %s: %r', path, e)
+        finally:
+            con.close()
+        if request_uuid and found:
+            break
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archives finished kharon requests and looks them up')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('run', help='archive finished requests and vacuum incrementally')
+    vacuum = commands.add_parser('vacuum', help='incremental vacuum only')
+    vacuum.add_argument('--full', action='store_true', help='one-time VACUUM switching to incremental auto_vacuum')
+    find = commands.add_parser('lookup', help='find a request in the database or the archives')
+    key = find.add_mutually_exclusive_group(required=True)
+    key.add_argument('--uuid')
+    key.add_argument('--trigger')
+    args = parser.parse_args(argv)
+
+    config = kh_config.load_config()
+    database_path = config['Database information']['database_path']
+    if args.command == 'run':
+        print(f'Archived {run(config)} requests')
+    elif args.command == 'vacuum':
+        if args.full:
+            full_vacuum(database_path)
+        print(f'{incremental_vacuum(database_path)} free pages left')
+    else:
+        archive_dir = config['Retention'].get('archive dir') if config.has_section('Retention') else None
+        archive_dir = archive_dir or os.path.join(os.path.dirname(database_path), 'archive')
+        for request in lookup(database_path, archive_dir, args.uuid, args.trigger):
+            print(json.dumps(request, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+import contextvars
+import random
+import time
+
+RETRYABLE = 'retryable'
+PERMANENT = 'permanent'
+
+# Client errors that say "not now" rather than "never"
+RETRYABLE_CLIENT_STATUSES = frozenset({408, 425, 429})
+
+# statusCode of records a Salesforce collection call rejected for their content, they are rejected again on retry
+PERMANENT_RECORD_ERRORS = frozenset({'INVALID_FIELD', 'REQUIRED_FIELD_MISSING', 'INVALID_FIELD_FOR_INSERT_UPDATE',
+                                     'INVALID_TYPE_ON_FIELD_IN_RECORD', 'FIELD_CUSTOM_VALIDATION_EXCEPTION',
+                                     'STRING_TOO_LONG', 'MALFORMED_ID', 'DUPLICATE_VALUE', 'DUPLICATE_EXTERNAL_ID',
+                                     'INVALID_OR_NULL_FOR_RESTRICTED_PICKLIST'})
+
+# Status of the last external response seen by the current request, set by http_session.
+# Handlers report most HTTP failures by returning a falsy result, this is how the dispatcher learns why
+last_status = contextvars.ContextVar('kharon_last_status', default=None)
+
+
+def record_status(status):
+    last_status.set(status)
+
+
+def reset_status():
+    last_status.set(None)
+
+
+async def to_thread(function, *args):
+    """asyncio.to_thread for handler code that records a status. The thread runs in a copy of the caller's
+    context, so the status is carried back with the result and recorded in the caller's context"""
+    def call():
+        try:
+            return function(*args), None, last_status.get()
+        except Exception as e:
+            return None, e, last_status.get()
+    result, exception, status = await asyncio.to_thread(call)
+    record_status(status)
+    if exception is not None:
+        raise exception
+    return result
+
+
+def classify_status(status):
+    """4xx responses (except 408/425/429) are permanent, everything else (5xx, 429, no response) is retryable.
+    A str status is the statusCode of a record rejected by a batch call, see PERMANENT_RECORD_ERRORS"""
+    if isinstance(status, str):
+        return PERMANENT if status in PERMANENT_RECORD_ERRORS else RETRYABLE
+    if status is not None and 400 <= int(status) < 500 and int(status) not in RETRYABLE_CLIENT_STATUSES:
+        return PERMANENT
+    return RETRYABLE
+
+
+def exception_status(exception):
+    response = getattr(exception, 'response', None)
+    status = getattr(exception, 'status', None) or getattr(response, 'status_code', None)
+    return status if isinstance(status, int) else None
+
+
+def classify_exception(exception):
+    """HTTP errors are classified by their status. Timeouts and connection errors (requests' exceptions are
+    OSErrors, httpx' are TransportErrors) are retryable; malformed requests (bad JSON, missing fields)
+    will fail the same way on every attempt and are permanent, unless the last response was a retryable
+    failure, in which case the exception is most likely the handler tripping over the error response"""
+    status = exception_status(exception)
+    if status is not None:
+        return classify_status(status)
+    status = last_status.get()
+    if status is not None and int(status) >= 400 and classify_status(status) == RETRYABLE:
+        return RETRYABLE
+    if isinstance(exception, (OSError, TimeoutError)) or type(exception).__name__ in {'TransportError',
+                                                                                      'TimeoutException',
+                                                                                      'NetworkError'}:
+        return RETRYABLE
+    if isinstance(exception, (ValueError, KeyError, TypeError)):
+        return PERMANENT
+    return RETRYABLE
+
+
+def classify_result():
+    """Classifies a falsy handler result by the last response the handler received"""
+    return classify_status(last_status.get())
+
+
+def describe_failure(exception=None):
+    if exception is not None:
+        return f'{type(exception).__name__}: {exception}'[:1000]
+    status = last_status.get()
+    return f'HTTP {status}' if status is not None else 'Handler reported failure'
+
+
+def backoff_seconds(attempt, base=30.0, cap=3600.0):
+    """Exponential backoff with equal jitter: half of base * 2^(attempt - 1) (capped) is fixed,
+    the other half random, so retries of a burst of failed requests spread out instead of arriving together"""
+    delay = min(cap, base * 2 ** max(attempt - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def next_attempt_at(attempt, config):
+    """Unix time of the next attempt after the given number of failed attempts, using 'retry base seconds'
+    and 'retry max seconds' from the [Dispatcher] section of kh.ini"""
+    return time.time() + backoff_seconds(attempt, float(config.get('retry base seconds', 30)),
+                                         float(config.get('retry max seconds', 3600)))
@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+import kh_logging
+from rate_limit import TokenBucket, SLACK_TIER_RATES
+
+logger = kh_logging.get_logger('slack_directory')
+
+directory_schema = '''
+CREATE TABLE IF NOT EXISTS slack_users
+(
+    [name] NVARCHAR(100) PRIMARY KEY NOT NULL,
+    [id] VARCHAR(40) NOT NULL,
+    [email] NVARCHAR(200)
+);
+CREATE TABLE IF NOT EXISTS slack_directory_state
+(
+    [key] VARCHAR(40) PRIMARY KEY NOT NULL,
+    [value] REAL
+);
+'''
+
+
+class SlackUserDirectory:
+    """Username -> Slack user id directory, kept in memory and persisted to a local SQLite file.
+    A full (cursor-paged) users.list sync only happens when the persisted copy is older than the TTL,
+    and then in the background. A lookup miss resolves e-mail addresses through users.lookupByEmail and
+    otherwise schedules a background re-sync, at most once per resync interval"""
+
+    def __init__(self, client, path='slack_users.db', ttl=86400, resync_interval=300, page_size=200):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.resync_interval = resync_interval
+        self.page_size = page_size
+        self.users = {}
+        self.synced_at = 0
+        self.sync_requested_at = 0
+        self.sync_lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.list_bucket = TokenBucket(SLACK_TIER_RATES[2], 1)
+        self.lookup_bucket = TokenBucket(SLACK_TIER_RATES[3], 5)
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.executescript(directory_schema)
+        self.load()
+        if not self.users:
+            self.sync()
+        elif time.time() - self.synced_at > self.ttl:
+            self.sync_in_background()
+
+    def load(self):
+        with self.db_lock:
+            self.users = {name: user_id for name, user_id in self.con.execute('SELECT name, id FROM slack_users')}
+            state = self.con.execute('SELECT value FROM slack_directory_state WHERE key = ?', ('synced_at',))
+            row = state.fetchone()
+            self.synced_at = row[0] if row else 0
+
+    def sync(self):
+        """Pages through users.list and replaces the directory with the result"""
+        if not self.sync_lock.acquire(blocking=False):
+            return
+        try:
+            users, cursor = [], None
+            while True:
+                self.list_bucket.acquire()
+                page = self.client.users_list(cursor=cursor, limit=self.page_size)
+                for user in page['members']:
+                    users.append((user['name'], user['id'], user.get('profile', {}).get('email')))
+                cursor = (page.get('response_metadata') or {}).get('next_cursor')
+                if not cursor:
+                    break
+            synced_at = time.time()
+            with self.db_lock:
+                with self.con:
+                    self.con.execute('DELETE FROM slack_users')
+                    self.con.executemany('INSERT OR REPLACE INTO slack_users (name, id, email) VALUES (?, ?, ?)',
+                                         users)
+                    self.con.execute('INSERT OR REPLACE INTO slack_directory_state (key, value) VALUES (?, ?)',
+                                     ('synced_at', synced_at))
+            self.users = {name: user_id for name, user_id, _ in users}
+            self.synced_at = synced_at
+            logger.info('Slack user directory synced, %s users', len(users))
+        finally:
+            self.sync_lock.release()
+
+    def _background_sync(self):
+        try:
+            self.sync()
+        except Exception:
+            logger.exception('Background sync of the Slack user directory failed')
+
+    def sync_in_background(self):
+        now = time.time()
+        if now - self.sync_requested_at < self.resync_interval:
+            return
+        self.sync_requested_at = now
+        threading.Thread(target=self._background_sync, name='kh-slack-directory', daemon=True).start()
+
+    def lookup_by_email(self, email):
+        self.lookup_bucket.acquire()
+        try:
+            user = self.client.users_lookupByEmail(email=email)['user']
+        except Exception as e:
+            logger.info('users.lookupByEmail found no Slack user for %s: %r', email, e)
+            return None
+        with self.db_lock:
+            with self.con:
+                self.con.execute('INSERT OR REPLACE INTO slack_users (name, id, email) VALUES (?, ?, ?)',
+                                 (email, user['id'], email))
+        self.users[email] = user['id']
+        return user['id']
+
+    def lookup(self, username):
+        """Returns the Slack user id for a username (or e-mail address), None if it is not known (yet)"""
+        if time.time() - self.synced_at > self.ttl:
+            self.sync_in_background()
+        user_id = self.users.get(username)
+        if user_id is not None:
+            return user_id
+        if '@' in username:
+            return self.lookup_by_email(username)
+        self.sync_in_background()
+        return None
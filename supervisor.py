@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import signal
+import time
+import kh_config
+import kh_logging
+
+logger = kh_logging.get_logger('supervisor')
+
+
+def worker_main(index, count):
+    """Entry point of a worker process. main is only imported here, so the supervisor itself stays small"""
+    import main
+    main.run_worker((index, count))
+
+
+def supervisor_settings(config):
+    """'workers' (one per CPU by default), 'restart delay' and 'max restart delay' (seconds, doubled after
+    every crash of the same worker) and 'shutdown timeout' from the [Supervisor] section of kh.ini"""
+    section = config['Supervisor'] if config.has_section('Supervisor') else {}
+    return {'workers': max(int(section.get('workers', 0)) or os.cpu_count() or 1, 1),
+            'restart delay': float(section.get('restart delay', 1)),
+            'max restart delay': float(section.get('max restart delay', 60)),
+            'shutdown timeout': float(section.get('shutdown timeout', 120))}
+
+
+class Supervisor:
+    """Runs [Supervisor] 'workers' dispatcher processes, each claiming the requests of its own partition of
+    TriggerObjects (see request_queue.partition_condition), and restarts the ones that exit unexpectedly.
+    SIGTERM and SIGINT are passed on to the workers, which finish their current batch before exiting.
+    SIGHUP makes every worker reload kh.ini between two batches; if 'workers' changed, the workers are
+    stopped the same way and started again with the new partitioning instead"""
+
+    def __init__(self):
+        self.context = multiprocessing.get_context('spawn')
+        self.settings = supervisor_settings(kh_config.load_config(force=True))
+        self.workers = {}
+        self.started_at = {}
+        # index -> exits in a row of a worker that did not stay up, and the monotonic time of its next start
+        self.crashes = {}
+        self.restart_at = {}
+        self.stopping = False
+        self.reload_requested = False
+
+    def start_worker(self, index):
+        process = self.context.Process(target=worker_main, args=(index, self.settings['workers']),
+                                       name=f'kh-dispatcher-{index}')
+        process.start()
+        self.workers[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.info('Started dispatcher worker %s of %s (pid %s)', index + 1, self.settings['workers'], process.pid)
+
+    def start_workers(self):
+        for index in range(self.settings['workers']):
+            self.start_worker(index)
+
+    def stop_workers(self):
+        """Sends SIGTERM to every worker and waits for them to finish their batch, killing the ones that
+        are still running after 'shutdown timeout' seconds (their leases expire and others retry them)"""
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.settings['shutdown timeout']
+        for index, process in self.workers.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning('Dispatcher worker %s did not stop in time, killing it', index + 1)
+                process.kill()
+                process.join()
+        self.workers = {}
+        self.crashes = {}
+        self.restart_at = {}
+
+    def reload(self):
+        self.reload_requested = False
+        settings = supervisor_settings(kh_config.load_config(force=True))
+        if settings['workers'] != self.settings['workers']:
+            logger.info('Restarting with %s dispatcher workers instead of %s', settings['workers'],
+                        self.settings['workers'])
+            self.stop_workers()
+            self.settings = settings
+            self.start_workers()
+            return
+        self.settings = settings
+        for process in self.workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+        logger.info('Configuration reload sent to %s dispatcher workers', len(self.workers))
+
+    def check_workers(self):
+        """Schedules a restart with backoff for every worker that exited, starts the ones that are due"""
+        now = time.monotonic()
+        for index, process in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            if index not in self.restart_at:
+                # A worker that stayed up for a while starts over with the shortest delay
+                if now - self.started_at[index] > self.settings['max restart delay']:
+                    self.crashes[index] = 0
+                self.crashes[index] = self.crashes.get(index, 0) + 1
+                delay = min(self.settings['restart delay'] * 2 ** (self.crashes[index] - 1),
+                            self.settings['max restart delay'])
+                logger.error('Dispatcher worker %s exited with code %s, restarting in %.0f seconds', index + 1,
+                             process.exitcode, delay)
+                self.restart_at[index] = now + delay
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self.start_worker(index)
+
+    def run(self):
+        config = kh_config.load_config()
+        kh_logging.setup_logging({key: config['Logging'][key] for key in config['Logging']}
+                                 if config.has_section('Logging') else {})
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        self.start_workers()
+        while not self.stopping:
+            time.sleep(0.5)
+            if self.reload_requested:
+                self.reload()
+            self.check_workers()
+        logger.info('Stopping %s dispatcher workers', len(self.workers))
+        self.stop_workers()
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+if __name__ == '__main__':
+    Supervisor().run()
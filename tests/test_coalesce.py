@@ -0,0 +1,75 @@
+from coalesce import Coalescer
+from request_envelope import RequestEnvelope
+from request_queue import StatusBatch, supersede_query
+
+config = {'supersede': 'obtain_yti_details, populate_yti_details',
+          'cancel': 'mention_case_in_yti > delete_kh_yt_comment'}
+
+
+def obtain(request_uuid, yt_readable_id='SF-200', trigger_object='500A'):
+    return RequestEnvelope(request_uuid, {'From': 'Salesforce', 'To': 'YouTrack', 'Function': 'obtain_yti_details',
+                                          'TriggerObject': trigger_object, 'YTReadableId': yt_readable_id})
+
+
+def mention(request_uuid, yt_readable_id='SF-200'):
+    return RequestEnvelope(request_uuid, {'From': 'Salesforce', 'To': 'YouTrack', 'Function': 'mention_case_in_yti',
+                                          'TriggerObject': '500A', 'YTReadableId': yt_readable_id,
+                                          'CaseInformation': {'CustomerInformation': {}}})
+
+
+def delete(request_uuid, yt_readable_id='SF-200'):
+    return RequestEnvelope(request_uuid, {'From': 'Salesforce', 'To': 'YouTrack', 'Function': 'delete_kh_yt_comment',
+                                          'TriggerObject': '500A', 'YTReadableId': yt_readable_id})
+
+
+def apply(kh_requests):
+    status_batch = StatusBatch()
+    kept, counts = Coalescer(config).apply(kh_requests, status_batch)
+    return [it_request.request_uuid for it_request in kept], counts, status_batch.updates.get(supersede_query, [])
+
+
+def test_latest_request_supersedes_earlier_ones():
+    kept, counts, superseded = apply([obtain('a'), obtain('b'), obtain('c')])
+    assert kept == ['c']
+    assert counts == {'superseded': 2}
+    assert superseded == [('b', 'a'), ('c', 'b')]
+
+
+def test_requests_about_other_issues_are_kept():
+    kept, counts, _ = apply([obtain('a', 'SF-200'), obtain('b', 'SF-201'), obtain('c', 'SF-200', '500B')])
+    assert kept == ['a', 'b', 'c']
+    assert counts == {}
+
+
+def test_delete_cancels_the_mention_before_it():
+    kept, counts, superseded = apply([mention('a'), obtain('b'), delete('c')])
+    assert kept == ['b']
+    assert counts == {'cancelled': 2}
+    assert sorted(superseded) == [('a', 'c'), ('c', 'a')]
+
+
+def test_delete_of_another_issue_cancels_nothing():
+    kept, counts, _ = apply([mention('a', 'SF-200'), delete('b', 'SF-201')])
+    assert kept == ['a', 'b']
+    assert counts == {}
+
+
+def test_delete_before_the_mention_cancels_nothing():
+    kept, _, _ = apply([delete('a'), mention('b')])
+    assert kept == ['a', 'b']
+
+
+def test_invalid_requests_pass_through_without_superseding_valid_ones():
+    invalid = RequestEnvelope('b', '{"From": "Salesforce", "To": "YouTrack", "Function": "obtain_yti_details", '
+                                   '"TriggerObject": "500A"}', destination='YouTrack', function='obtain_yti_details',
+                              trigger_object='500A')
+    undecodable = RequestEnvelope('c', 'not json', destination='YouTrack', function='obtain_yti_details',
+                                  trigger_object='500A')
+    kept, counts, _ = apply([obtain('a'), invalid, undecodable])
+    assert kept == ['a', 'b', 'c']
+    assert counts == {}
+
+
+def test_disabled_without_rules():
+    kh_requests = [obtain('a'), obtain('b')]
+    assert Coalescer({}).apply(kh_requests, StatusBatch()) == (kh_requests, {})
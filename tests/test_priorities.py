@@ -0,0 +1,18 @@
+import priorities
+
+
+def test_shares_follow_the_weights():
+    assert priorities.shares(100, priorities.parse_weights(None)) == [(0, 70), (1, 25), (2, 5)]
+
+
+def test_shares_rounding_to_zero_still_get_a_row():
+    assert priorities.shares(10, {0: 98.0, 1: 1.0, 2: 1.0}) == [(0, 8), (1, 1), (2, 1)]
+
+
+def test_shares_of_a_batch_smaller_than_the_priorities():
+    assert priorities.shares(2, priorities.parse_weights(None)) == [(0, 1), (1, 1), (2, 1)]
+
+
+def test_shares_skip_priorities_without_weight():
+    assert priorities.shares(10, {0: 1.0, 2: 0.0}) == [(0, 10)]
+    assert priorities.shares(10, {}) == []
@@ -0,0 +1,67 @@
+import json
+import time
+import kh_db
+from request_queue import RequestQueue, StatusBatch, dispatch_order
+
+
+def row(row_id, trigger_object, priority, created_datetime):
+    return (row_id, f'uuid-{row_id}', 'YouTrack', 'obtain_yti_details', trigger_object, '{}', None, 0,
+            created_datetime, priority)
+
+
+def test_dispatch_order_is_by_priority_then_age():
+    rows = [row(1, 'A', 2, '2026-01-01T00:00:01'), row(2, 'B', 0, '2026-01-01T00:00:03'),
+            row(3, 'C', 1, '2026-01-01T00:00:02'), row(4, 'D', 0, '2026-01-01T00:00:02')]
+    assert [it[0] for it in dispatch_order(rows)] == [4, 2, 3, 1]
+
+
+def test_dispatch_order_promotes_earlier_rows_of_a_chain():
+    rows = [row(1, 'A', 1, '2026-01-01T00:00:01'), row(2, 'B', 0, '2026-01-01T00:00:01'),
+            row(3, 'A', 0, '2026-01-01T00:00:02'), row(4, None, 2, '2026-01-01T00:00:00')]
+    # 1 runs at the priority of 3, which has to wait for it
+    assert [it[0] for it in dispatch_order(rows)] == [1, 2, 3, 4]
+
+
+def seed(database_path, requests):
+    con = kh_db.connect(database_path)
+    with con:
+        for request_uuid, function, trigger_object, priority, created_datetime in requests:
+            body = {'From': 'Salesforce', 'To': 'YouTrack', 'Function': function, 'TriggerObject': trigger_object,
+                    'YTReadableId': 'SF-200'}
+            con.execute('INSERT INTO kharon_requests (requestUUID, requestBody, requestedFunction, requestTo, '
+                        'createdDatetime, TriggerObject, priority) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (request_uuid, json.dumps(body), function, 'YouTrack', created_datetime, trigger_object,
+                         priority))
+    con.close()
+
+
+def claimed(queue):
+    return [envelope.request_uuid for envelope in queue.claim()]
+
+
+def test_claim_keeps_the_order_of_a_trigger_object(tmp_path):
+    database_path = str(tmp_path / 'kharon.db')
+    seed(database_path, [('mention', 'mention_case_in_yti', '500A', 1, '2026-01-01T00:00:01'),
+                         ('delete', 'delete_kh_yt_comment', '500A', 0, '2026-01-01T00:00:02'),
+                         ('other', 'obtain_yti_details', '500B', 0, '2026-01-01T00:00:03')])
+    queue = RequestQueue(database_path, worker_id='worker-1', batch_size=2)
+    # The delete has the higher priority, but must not run before (or next to) the older mention
+    assert claimed(queue) == ['other', 'mention']
+    assert claimed(RequestQueue(database_path, worker_id='worker-2', batch_size=2)) == []
+    status_batch = StatusBatch()
+    status_batch.complete('mention')
+    status_batch.complete('other')
+    queue.finish(status_batch)
+    assert claimed(queue) == ['delete']
+
+
+def test_backed_off_row_holds_back_its_trigger_object(tmp_path):
+    database_path = str(tmp_path / 'kharon.db')
+    seed(database_path, [('first', 'obtain_yti_details', '500A', 1, '2026-01-01T00:00:01'),
+                         ('second', 'obtain_yti_details', '500A', 1, '2026-01-01T00:00:02')])
+    queue = RequestQueue(database_path, worker_id='worker-1', batch_size=10)
+    assert claimed(queue) == ['first']
+    status_batch = StatusBatch()
+    status_batch.fail('first', 1, next_attempt_at=time.time() + 3600, error='HTTP 503')
+    queue.finish(status_batch)
+    assert claimed(queue) == []
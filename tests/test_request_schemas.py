@@ -0,0 +1,50 @@
+import pytest
+import request_schemas
+
+
+def slack_notification(**fields):
+    request_body = {'From': 'Salesforce', 'To': 'Slack', 'Function': 'send_slack_notification',
+                    'notification_destination_type': 'channel', 'notification_destination': 'C0123',
+                    'notification_text': 'Case escalated'}
+    request_body.update(fields)
+    return {key: value for key, value in request_body.items() if value is not None}
+
+
+def test_valid_request():
+    assert request_schemas.validate(slack_notification()) == []
+
+
+@pytest.mark.parametrize('request_body', [None, [], 'text'])
+def test_request_must_be_an_object(request_body):
+    assert request_schemas.validate(request_body) == ['a JSON object is required']
+
+
+def test_identity_fields_are_checked_first():
+    assert request_schemas.validate({'To': 'Slack', 'notification_text': ''}) == ['From: missing',
+                                                                                  'Function: missing']
+
+
+def test_unknown_destination_and_function():
+    assert request_schemas.validate(slack_notification(To='Jira')) == ['To: unknown destination Jira']
+    assert request_schemas.validate(slack_notification(Function='delete_message')) == [
+        'Function: Slack has no function delete_message']
+
+
+def test_every_failing_field_is_reported():
+    assert request_schemas.validate(slack_notification(notification_destination_type='group',
+                                                       notification_destination=None,
+                                                       notification_text='  ')) == [
+        'notification_destination_type: one of user, channel is required',
+        'notification_destination: missing',
+        'notification_text: a non-empty string is required']
+
+
+def test_nested_fields():
+    request_body = {'From': 'YouTrack', 'To': 'Salesforce', 'Function': 'populate_yti_details',
+                    'YoutrackIssue': {'YTReadableId': 'SF-200'}}
+    assert request_schemas.validate(request_body) == []
+    request_body['YoutrackIssue'] = {}
+    assert request_schemas.validate(request_body) == ['YoutrackIssue.YTReadableId: missing']
+    request_body['YoutrackIssue'] = 'SF-200'
+    assert request_schemas.validate(request_body) == ['YoutrackIssue: an object is required',
+                                                      'YoutrackIssue.YTReadableId: missing']
@@ -0,0 +1,82 @@
+import asyncio
+import contextvars
+import pytest
+import retry_policy
+from retry_policy import PERMANENT, RETRYABLE
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f'HTTP {status_code}')
+        self.response = type('Response', (), {'status_code': status_code})()
+
+
+def in_fresh_context(function, *args):
+    return contextvars.copy_context().run(function, *args)
+
+
+@pytest.mark.parametrize('status, error_class', [
+    (400, PERMANENT), (404, PERMANENT), (408, RETRYABLE), (425, RETRYABLE), (429, RETRYABLE),
+    (500, RETRYABLE), (503, RETRYABLE), (None, RETRYABLE),
+    ('INVALID_FIELD', PERMANENT), ('REQUIRED_FIELD_MISSING', PERMANENT), ('UNABLE_TO_LOCK_ROW', RETRYABLE)
+])
+def test_classify_status(status, error_class):
+    assert retry_policy.classify_status(status) == error_class
+
+
+@pytest.mark.parametrize('exception, error_class', [
+    (HTTPError(404), PERMANENT), (HTTPError(502), RETRYABLE), (ConnectionError('reset'), RETRYABLE),
+    (TimeoutError(), RETRYABLE), (KeyError('YTReadableId'), PERMANENT), (ValueError('bad JSON'), PERMANENT),
+    (RuntimeError('unexpected'), RETRYABLE)
+])
+def test_classify_exception(exception, error_class):
+    def classify():
+        retry_policy.reset_status()
+        return retry_policy.classify_exception(exception)
+    assert in_fresh_context(classify) == error_class
+
+
+def test_classify_exception_after_a_retryable_response():
+    def classify():
+        # A handler tripping over a 503 response body is not a malformed request
+        retry_policy.record_status(503)
+        return retry_policy.classify_exception(KeyError('id'))
+    assert in_fresh_context(classify) == RETRYABLE
+
+
+@pytest.mark.parametrize('status, error_class, description', [
+    (None, RETRYABLE, 'Handler reported failure'), (404, PERMANENT, 'HTTP 404'), (503, RETRYABLE, 'HTTP 503')
+])
+def test_classify_result(status, error_class, description):
+    def classify():
+        retry_policy.record_status(status)
+        return retry_policy.classify_result(), retry_policy.describe_failure()
+    assert in_fresh_context(classify) == (error_class, description)
+
+
+def test_to_thread_keeps_the_status_of_the_thread():
+    def handler():
+        retry_policy.record_status(429)
+        return False
+
+    async def run():
+        retry_policy.reset_status()
+        return await retry_policy.to_thread(handler), retry_policy.last_status.get()
+    assert asyncio.run(run()) == (False, 429)
+
+
+def test_to_thread_keeps_the_status_of_a_failed_thread():
+    def handler():
+        retry_policy.record_status(503)
+        raise KeyError('id')
+
+    async def run():
+        with pytest.raises(KeyError):
+            await retry_policy.to_thread(handler)
+        return retry_policy.classify_exception(KeyError('id'))
+    assert asyncio.run(run()) == RETRYABLE
+
+
+def test_backoff_stays_between_half_and_full_delay():
+    for attempt, delay in ((1, 30.0), (3, 120.0), (20, 3600.0)):
+        assert delay / 2 <= retry_policy.backoff_seconds(attempt) <= delay
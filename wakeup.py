@@ -0,0 +1,99 @@
+import glob
+import os
+import select
+import socket
+import threading
+import time
+
+_notify_socket = None
+_notify_lock = threading.Lock()
+# socket_path -> (monotonic time of the lookup, sockets to notify), see notify_targets
+_notify_targets = {}
+TARGETS_TTL = 5
+
+
+class DispatcherWakeup:
+    """Idle wait of the dispatcher that ends as soon as new requests are queued.
+    With a socket path the dispatcher listens on a Unix datagram socket and the /api ingestion sends it
+    a datagram after every insert (see notify); the wait still times out after max_idle so rows that
+    become claimable on their own (expired leases, retries) are picked up.
+    Without a socket path, or where Unix sockets are not available, the wait falls back to an adaptive
+    backoff from min_idle up to max_idle"""
+
+    def __init__(self, socket_path=None, min_idle=0.05, max_idle=1.0):
+        self.socket_path = socket_path
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.idle = min_idle
+        self.sock = None
+        if socket_path and hasattr(socket, 'AF_UNIX'):
+            try:
+                if os.path.exists(socket_path):
+                    os.unlink(socket_path)
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.sock.bind(socket_path)
+                self.sock.setblocking(False)
+            except OSError:
+                self.sock = None
+
+    def drain(self):
+        try:
+            while self.sock.recv(64):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def wait(self):
+        """Waits until notified or until the idle timeout elapses, returns True if notified"""
+        if self.sock is None:
+            time.sleep(self.idle)
+            self.idle = min(self.idle * 2, self.max_idle)
+            return False
+        readable, _, _ = select.select([self.sock], [], [], self.max_idle)
+        if readable:
+            self.drain()
+        return bool(readable)
+
+    def reset(self):
+        """Called after work was found, so the next idle period starts with the shortest backoff"""
+        self.idle = self.min_idle
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+def notify_targets(socket_path):
+    """socket_path and the '<socket_path>.<n>' sockets of the workers started by supervisor.py,
+    looked up again every TARGETS_TTL seconds as workers come and go"""
+    now = time.monotonic()
+    cached = _notify_targets.get(socket_path)
+    if cached is None or now - cached[0] > TARGETS_TTL:
+        cached = (now, [socket_path] + sorted(glob.glob(glob.escape(socket_path) + '.*')))
+        _notify_targets[socket_path] = cached
+    return cached[1]
+
+
+def notify(socket_path):
+    """Wakes the dispatchers listening on socket_path. Never blocks and never fails: if a dispatcher is
+    not running or already has a wakeup pending, it will find the new rows on its next poll anyway"""
+    global _notify_socket
+    if not socket_path or not hasattr(socket, 'AF_UNIX'):
+        return False
+    notified = False
+    with _notify_lock:
+        for target in notify_targets(socket_path):
+            try:
+                if _notify_socket is None:
+                    _notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    _notify_socket.setblocking(False)
+                _notify_socket.sendto(b'1', target)
+                notified = True
+            except OSError:
+                pass
+    return notified